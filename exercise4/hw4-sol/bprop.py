@@ -1,5 +1,7 @@
-from functools import reduce
+from contextlib import contextmanager
+import heapq
 import math
+from multiprocessing.pool import ThreadPool
 import networkx as nx
 import numpy as np
 import matplotlib.pyplot as plt
@@ -14,13 +16,6 @@ class Node(object):
     def connect_to(self, node):
         self.neighbors.append(node)
 
-    def send(self):
-        for fnode in self.neighbors:
-            self.send_one(fnode)
-
-    def receive(self, source, msg):
-        self.received[source] = msg
-
 
 class VariableNode(Node):
     def __init__(self, name, domain):
@@ -40,32 +35,28 @@ class VariableNode(Node):
         self.domain = range(len(domain))
         self.orig_domain = domain
         self.orig2new = dict(zip(domain, self.domain))
+        # Log potential of the evidence on this variable, i.e., zero for the
+        # observed value and -1e6 (log 0) for all others, or all zeros if
+        # the variable is not observed.
+        self.evidence = np.zeros(len(self.domain))
 
-    def init_received(self):
-        """
-        Initially, "hallucinate" received messages of all ones (zeros in the
-        log domain) to start the message passing algorithm.
-        """
-        self.received = {fnode: np.zeros(len(self.domain))
-                         for fnode in self.neighbors}
-
-    def send_one(self, target):
-        """Send a message to the target factor.
+    def observe(self, value):
+        """Clamp the variable to the given (original) value."""
+        if value not in self.orig2new:
+            raise RuntimeError("Unknown value '{0}' of variable '{1}'".format(
+                value, self.name))
+        # Write in place, since the evidence may be a view into a
+        # ``CompiledGraph``.
+        self.evidence[...] = -1e6
+        self.evidence[self.orig2new[value]] = 0
 
-        Arguments
-        ---------
-        target: str
-            The target factor, which should be a neighbor in the factor graph.
-        """
-        msg = np.zeros(len(self.domain))
-        for fnode in self.neighbors:
-            if fnode != target:
-                msg += self.received[fnode]
-        target.receive(self, normalize(msg))
+    def unobserve(self):
+        """Remove the evidence on the variable."""
+        self.evidence[...] = 0
 
     def marginal(self):
         """Compute the marginal probability distribution of this variable."""
-        m = np.zeros(len(self.domain))
+        m = self.evidence.copy()
         for fnode in self.neighbors:
             m += self.received[fnode]
         return np.exp(normalize(m))
@@ -81,50 +72,790 @@ class FactorNode(Node):
         variables : iterable
             The variables that are in this factor. The order matters.
 
-        table : map
+        table : map or numpy.ndarray
             Maps every tuple of possible values (v_1, ..., v_n) the variables
-            in this factor can take to the value of the factor.
+            in this factor can take to the value of the factor. Alternatively,
+            a dense array with one axis per variable, indexed by the positions
+            of the values in the respective domains.
         """
         super(FactorNode, self).__init__()
         self.variables = variables
-        # Map table combinations to numerical values.
-        self.table = {}
-        for comb, fvalue in table.items():
-            newcomb = tuple(graph.vs[v].orig2new[orig]
-                            for v, orig in zip(variables, comb))
-            self.table[newcomb] = fvalue
         self.name = 'F_' + ''.join(variables)
+        self.set_table(graph, table)
+
+    def set_table(self, graph, table):
+        """Set the factor table, which is stored as a dense array in the log
+        domain with one axis per variable.
+
+        Arguments
+        ---------
+        graph : FactorGraph
+
+        table : map or numpy.ndarray
+            The factor table in any of the forms accepted by the constructor.
+        """
+        shape = tuple(len(graph.vs[v].domain) for v in self.variables)
+        if isinstance(table, dict):
+            # Map table combinations to numerical values. Missing combinations
+            # have a factor value of zero.
+            values = np.zeros(shape)
+            for comb, fvalue in table.items():
+                newcomb = tuple(graph.vs[v].orig2new[orig]
+                                for v, orig in zip(self.variables, comb))
+                values[newcomb] = fvalue
+        else:
+            values = np.asarray(table, dtype=float)
+            if values.shape != shape:
+                raise RuntimeError(
+                    "Expected factor table of shape {0}, got {1}".format(
+                        shape, values.shape))
         # Just to avoid annoying numpy warnings for log(0).
-        for k, v in self.table.items():
-            if v == 0:
-                self.table[k] = -1e6
+        self.table = -1e6 * np.ones(shape)
+        nonzero = values != 0
+        self.table[nonzero] = np.log(values[nonzero])
+        graph.tables_changed(self)
+
+
+class MarkovBlanketIndex:
+    """An integer-indexed snapshot of the structure of a factor graph.
+
+    Variables are numbered in the order of ``graph.vs`` and factors in the
+    order of ``graph.fs``.
+    """
+    def __init__(self, graph):
+        self.names = list(graph.vs.keys())
+        self.ids = {v: i for i, v in enumerate(self.names)}
+        self.factors = list(graph.fs)
+        factor_ids = {f: i for i, f in enumerate(self.factors)}
+        # Variables of each factor in the order of the table axes.
+        self.factor_vars = [np.array([self.ids[v] for v in f.variables],
+                                     dtype=int)
+                            for f in self.factors]
+        # Neighboring factors of each variable.
+        self.var_factors = [np.array([factor_ids[f] for f in vnode.neighbors],
+                                     dtype=int)
+                            for vnode in graph.vs.values()]
+        # All other variables that share a factor with each variable.
+        self.blankets = []
+        for i, fids in enumerate(self.var_factors):
+            blanket = set()
+            for f in fids:
+                blanket.update(self.factor_vars[f])
+            blanket.discard(i)
+            self.blankets.append(np.array(sorted(blanket), dtype=int))
+
+
+class FactorGroup:
+    """Factors of a ``CompiledGraph`` that have the same table shape."""
+    def __init__(self, factors, tables, index):
+        # Ids of the factors in the group.
+        self.factors = np.array(factors, dtype=int)
+        # Stacked factor tables with the group as first axis.
+        self.tables = tables
+        # For every table axis, a (group size) x (axis length) array of the
+        # positions of the respective messages in the message buffers.
+        self.index = index
+
+
+class CompiledGraph:
+    """An edge-indexed layout of a factor graph, in which all messages are
+    stored in two flat buffers.
+
+    Variables are numbered in the order of ``graph.vs`` and factors in the
+    order of ``graph.fs``. Edges are numbered by variable and, for each
+    variable, in the order of its neighbors. The messages along edge e are
+    stored at positions offsets[e]:offsets[e + 1] of the buffers ``v2f``
+    (from variable to factor) and ``f2v`` (from factor to variable).
+
+    Each variable also has a slot of positions
+    var_offsets[v]:var_offsets[v + 1], one for each of its values, which is
+    used for sums of messages and for marginals. The ``evidence`` of all
+    variables is stored by slot as well.
+
+    The messages of observed variables are fixed to their evidence. The
+    flooding schedule therefore skips them, and sends the messages of the
+    other variables with the factor tables sliced at the observed values
+    (see ``prepare_evidence``).
+    """
+    def __init__(self, graph):
+        self.vnodes = list(graph.vs.values())
+        self.fnodes = list(graph.fs)
+        self.var_ids = {vnode.name: v for v, vnode in enumerate(self.vnodes)}
+        self.factor_ids = {f: i for i, f in enumerate(self.fnodes)}
+        sizes = [len(vnode.domain) for vnode in self.vnodes]
+        self.var_offsets = np.zeros(len(sizes) + 1, dtype=int)
+        self.var_offsets[1:] = np.cumsum(sizes)
+        # Make the evidence of every variable a view into one array, so that
+        # observing a variable does not require compiling the graph again.
+        self.evidence = np.zeros(self.var_offsets[-1])
+        for v, vnode in enumerate(self.vnodes):
+            lo, hi = self.var_offsets[v], self.var_offsets[v + 1]
+            self.evidence[lo:hi] = vnode.evidence
+            vnode.evidence = self.evidence[lo:hi]
+        edge_var = []
+        edge_factor = []
+        edge_axis = []
+        for v, vnode in enumerate(self.vnodes):
+            for fnode in vnode.neighbors:
+                edge_var.append(v)
+                edge_factor.append(self.factor_ids[fnode])
+                edge_axis.append(fnode.neighbors.index(vnode))
+        self.edge_var = np.array(edge_var, dtype=int)
+        self.edge_factor = np.array(edge_factor, dtype=int)
+        self.edge_axis = np.array(edge_axis, dtype=int)
+        edge_sizes = np.array([sizes[v] for v in edge_var], dtype=int)
+        self.offsets = np.zeros(len(edge_var) + 1, dtype=int)
+        self.offsets[1:] = np.cumsum(edge_sizes)
+        # For every buffer position, its edge and the variable slot position
+        # of its value.
+        self.elem_edge = np.repeat(np.arange(len(edge_var)), edge_sizes)
+        self.elem_slot = (
+            self.var_offsets[self.edge_var[self.elem_edge]] +
+            np.arange(self.offsets[-1]) - self.offsets[self.elem_edge])
+        # Buffer positions ordered by slot, to sum messages per slot.
+        self.slot_order = np.argsort(self.elem_slot, kind='mergesort')
+        sorted_slots = self.elem_slot[self.slot_order]
+        first = np.ones(len(sorted_slots), dtype=bool)
+        first[1:] = sorted_slots[1:] != sorted_slots[:-1]
+        self.slot_starts = np.flatnonzero(first)
+        self.used_slots = sorted_slots[self.slot_starts]
+        self.slot_var = np.repeat(np.arange(len(sizes)), sizes)
+        # Group factors by table shape.
+        edge_ids = {(f, a): e for e, (f, a) in
+                    enumerate(zip(edge_factor, edge_axis))}
+        shapes = {}
+        for f, fnode in enumerate(self.fnodes):
+            shapes.setdefault(fnode.table.shape, []).append(f)
+        self.groups = []
+        for shape, factors in shapes.items():
+            tables = np.array([self.fnodes[f].table for f in factors])
+            index = [np.array([np.arange(self.offsets[edge_ids[(f, a)]],
+                                         self.offsets[edge_ids[(f, a)] + 1])
+                               for f in factors], dtype=int)
+                     for a in range(len(shape))]
+            self.groups.append(FactorGroup(factors, tables, index))
+        # Edges of every factor in the order of its table axes, and edges of
+        # every variable, which are edges var_edge_ptr[v]:var_edge_ptr[v + 1].
+        self.factor_edges = [
+            [edge_ids[(f, a)] for a in range(fnode.table.ndim)]
+            for f, fnode in enumerate(self.fnodes)]
+        self.var_edge_ptr = np.zeros(len(sizes) + 1, dtype=int)
+        self.var_edge_ptr[1:] = np.cumsum(
+            np.bincount(self.edge_var, minlength=len(sizes)))
+        self.v2f = np.zeros(self.offsets[-1])
+        self.f2v = np.zeros(self.offsets[-1])
+        self.tree_order = False  # Not computed yet.
+        self.f2v_change = None
+        # The group and the row in it of every factor.
+        self.factor_rows = [None] * len(self.fnodes)
+        for group in self.groups:
+            for row, f in enumerate(group.factors):
+                self.factor_rows[f] = (group, row)
+        # Whether the buffers hold the messages of a previous run, and the
+        # variables and factors whose evidence or table changed since.
+        self.has_messages = False
+        self.dirty_vars = set()
+        self.dirty_factors = set()
+        # Whether each variable is observed, or None if the evidence changed
+        # since the layout of the free variables and factors was computed.
+        self.observed = None
+
+    def reset(self):
+        """Reset all messages to all ones (zeros in the log domain), except
+        that observed variables send their evidence, and make the
+        ``received`` messages of all nodes views into the buffers."""
+        self.v2f[:] = self.evidence[self.elem_slot]
+        self.f2v.fill(0)
+        for vnode in self.vnodes:
+            vnode.received = {}
+        for fnode in self.fnodes:
+            fnode.received = {}
+        for e, (v, f) in enumerate(zip(self.edge_var, self.edge_factor)):
+            vnode, fnode = self.vnodes[v], self.fnodes[f]
+            lo, hi = self.offsets[e], self.offsets[e + 1]
+            vnode.received[fnode] = self.f2v[lo:hi]
+            fnode.received[vnode] = self.v2f[lo:hi]
+        self.has_messages = False
+        self.dirty_vars.clear()
+        self.dirty_factors.clear()
+
+    def update_table(self, f):
+        """Copy the table of factor ``f`` to its group after it changed."""
+        group, row = self.factor_rows[f]
+        group.tables[row] = self.fnodes[f].table
+        self.dirty_factors.add(f)
+        self.observed = None
+
+    def evidence_changed(self, v):
+        """Fix the messages of variable ``v`` to its evidence after it
+        changed. If ``v`` is no longer observed, its messages are uniform
+        until they are sent again."""
+        lo = self.offsets[self.var_edge_ptr[v]]
+        hi = self.offsets[self.var_edge_ptr[v + 1]]
+        self.v2f[lo:hi] = self.evidence[self.elem_slot[lo:hi]]
+        self.dirty_vars.add(v)
+        self.observed = None
+
+    def prepare_evidence(self):
+        """Compute the layout of the messages of unobserved variables, and the
+        factor groups with all tables sliced at the observed values, unless
+        the evidence did not change since.
+
+        The messages of unobserved (free) variables are at the positions
+        ``free_elems`` of the buffers, and those of free edge
+        ``free_edges[i]`` are at positions free_starts[i]:free_starts[i + 1]
+        of ``free_elems``. Only the messages to free variables are sent by
+        the ``free_groups``.
+        """
+        if self.observed is not None:
+            return
+        nvars = len(self.vnodes)
+        self.observed = np.zeros(nvars, dtype=bool)
+        if nvars:
+            self.observed[:] = np.minimum.reduceat(
+                self.evidence, self.var_offsets[:-1]) < 0
+        free_edge = ~self.observed[self.edge_var]
+        self.free_edges = np.flatnonzero(free_edge)
+        self.free_elems = np.flatnonzero(free_edge[self.elem_edge])
+        sizes = np.diff(self.offsets)[free_edge]
+        self.free_starts = np.zeros(len(sizes) + 1, dtype=int)
+        self.free_starts[1:] = np.cumsum(sizes)
+        self.free_segments = np.repeat(np.arange(len(sizes)), sizes)
+        if not self.observed.any():
+            self.free_groups = self.groups
+            return
+        shapes = {}
+        for f, fnode in enumerate(self.fnodes):
+            index = []
+            edges = []
+            for e in self.factor_edges[f]:
+                v = self.edge_var[e]
+                if self.observed[v]:
+                    lo, hi = self.var_offsets[v], self.var_offsets[v + 1]
+                    index.append(int(np.argmax(self.evidence[lo:hi])))
+                else:
+                    index.append(slice(None))
+                    edges.append(e)
+            if edges:
+                table = fnode.table[tuple(index)]
+                shapes.setdefault(table.shape, []).append((f, table, edges))
+        self.free_groups = []
+        for shape, items in shapes.items():
+            index = [np.array([np.arange(self.offsets[edges[a]],
+                                         self.offsets[edges[a] + 1])
+                               for _, _, edges in items], dtype=int)
+                     for a in range(len(shape))]
+            self.free_groups.append(FactorGroup(
+                [f for f, _, _ in items],
+                np.array([table for _, table, _ in items]), index))
+
+    def pop_dirty(self):
+        """Get and forget the lists of variables whose evidence and factors
+        whose table changed since the last run."""
+        dirty = sorted(self.dirty_vars), sorted(self.dirty_factors)
+        self.dirty_vars.clear()
+        self.dirty_factors.clear()
+        return dirty
+
+    def sum_messages(self):
+        """Sum the evidence and the messages received by each variable for
+        each of its values, which gives an array indexed by slot positions."""
+        total = self.evidence.copy()
+        if len(self.slot_starts):
+            total[self.used_slots] += np.add.reduceat(
+                self.f2v[self.slot_order], self.slot_starts)
+        return total
+
+    def send_variables(self, start=0, stop=None):
+        """Send the messages of the unobserved variables among ``start`` to
+        ``stop - 1`` (by default, all variables) at once, same as
+        ``send_variable``. The messages of observed variables are fixed to
+        their evidence.
+
+        The messages of a range of variables occupy a contiguous range of the
+        buffers, so that different ranges can be sent concurrently.
+        """
+        self.prepare_evidence()
+        if stop is None:
+            stop = len(self.vnodes)
+        e0, e1 = self.var_edge_ptr[start], self.var_edge_ptr[stop]
+        lo, hi = self.offsets[e0], self.offsets[e1]
+        a, b = np.searchsorted(self.free_elems, [lo, hi])
+        if a == b:
+            return
+        s0, s1 = np.searchsorted(self.free_edges, [e0, e1])
+        if b - a == hi - lo:
+            elems = slice(lo, hi)
+        else:
+            elems = self.free_elems[a:b]
+        received = self.f2v[elems]
+        slots = self.elem_slot[elems] - self.var_offsets[start]
+        nslots = self.var_offsets[stop] - self.var_offsets[start]
+        total = np.bincount(slots, weights=received, minlength=nslots)
+        self.v2f[elems] = normalize_segments(total[slots] - received,
+                                             self.free_starts[s0:s1] - a,
+                                             self.free_segments[a:b] - s0)
+
+    def send_factors(self):
+        """Send the messages of all factors to unobserved variables, same as
+        ``compute_factor``, with one set of array operations per group of
+        factors with the same (sliced) table shape."""
+        self.prepare_evidence()
+        for group in self.free_groups:
+            self.send_group(group)
+
+    def send_group(self, group, start=0, stop=None):
+        """Send the messages of the factors ``start`` to ``stop - 1`` (by
+        default, all factors) of a group. Different ranges of factors write
+        to disjoint positions of ``f2v``, so that they can be sent
+        concurrently."""
+        tables = group.tables[start:stop]
+        if len(tables) == 0:
+            return
+        index = [idx[start:stop] for idx in group.index]
+        ndim = tables.ndim
+        msgs = [self.v2f[idx] for idx in index]
+        s = tables
+        for a, msg in enumerate(msgs):
+            s = s + expand_axis(msg, a + 1, ndim, batched=True)
+        for a, msg in enumerate(msgs):
+            others = tuple(j for j in range(1, ndim) if j != a + 1)
+            self.f2v[index[a]] = logsumexp(s, axis=others) - msg
+
+    def get_partition(self, nworkers):
+        """Split the variables and the factors of each group into (at most)
+        ``nworkers`` ranges of about the same size.
+
+        Returns
+        -------
+        A tuple containing (1) a list of (start, stop) ranges of variables,
+        balanced by the number of message elements, and (2) a list of
+        (group, start, stop) ranges of factors.
+        """
+        nvars = len(self.vnodes)
+        sizes = self.offsets[self.var_edge_ptr]
+        targets = np.linspace(0, sizes[-1], nworkers + 1)[1:-1]
+        bounds = np.unique(np.concatenate(
+            ([0], np.searchsorted(sizes, targets), [nvars])))
+        var_ranges = list(zip(bounds[:-1], bounds[1:]))
+        factor_ranges = []
+        self.prepare_evidence()
+        for group in self.free_groups:
+            n = len(group.tables)
+            step = -(-n // nworkers)
+            factor_ranges.extend((group, i, min(i + step, n))
+                                 for i in range(0, n, step))
+        return var_ranges, factor_ranges
+
+    def send_variable(self, v, skip=None, only=None):
+        """Send the messages of variable ``v`` along all its edges, except edge
+        ``skip``, or only along edge ``only``.
+
+        The message along an edge is the normalized sum of the evidence and
+        the messages received along all other edges. The sum of all received
+        messages is computed once and the message received along each edge is
+        subtracted from it. This is exact, since factor tables, and hence all
+        messages, are finite.
+        """
+        lo, hi = self.var_offsets[v], self.var_offsets[v + 1]
+        first, last = self.var_edge_ptr[v], self.var_edge_ptr[v + 1]
+        received = self.f2v[self.offsets[first]:self.offsets[last]]
+        total = (self.evidence[lo:hi] +
+                 received.reshape(last - first, hi - lo).sum(axis=0))
+        for e in range(first, last):
+            if e != skip and only in (None, e):
+                lo, hi = self.offsets[e], self.offsets[e + 1]
+                self.v2f[lo:hi] = normalize(total - self.f2v[lo:hi])
+
+    def compute_factor(self, f, out, skip=None, only=None):
+        """Compute the messages of factor ``f`` along all its edges, except
+        edge ``skip``, or only along edge ``only``, and write them to the
+        respective positions of ``out``.
+
+        The factor table is combined with all received messages once, and
+        summed over all axes but the one of the edge. Since the message
+        received along the edge is constant along all other axes, it can be
+        subtracted after summing over them.
+        """
+        table = self.fnodes[f].table
+        edges = self.factor_edges[f]
+        msgs = [self.v2f[self.offsets[e]:self.offsets[e + 1]] for e in edges]
+        s = table
+        for a, msg in enumerate(msgs):
+            s = s + expand_axis(msg, a, table.ndim)
+        for a, e in enumerate(edges):
+            if e != skip and only in (None, e):
+                others = tuple(j for j in range(table.ndim) if j != a)
+                out[self.offsets[e]:self.offsets[e + 1]] = (
+                    logsumexp(s, axis=others) - msgs[a])
+
+    def get_tree_order(self):
+        """Get an order of the nodes for the two-pass schedule on trees.
+
+        The order is computed once and reused.
+
+        Returns
+        -------
+        None if the graph has a cycle. Otherwise, a list of the nodes of every
+        connected component in breadth-first order from a root variable. Each
+        node is given as a tuple (is_variable, id, parent_edge), where
+        parent_edge is the edge to the parent node, or None for roots.
+        """
+        if self.tree_order is False:
+            self.tree_order = self.find_tree_order()
+        return self.tree_order
+
+    def find_tree_order(self):
+        var_seen = np.zeros(len(self.vnodes), dtype=bool)
+        factor_seen = np.zeros(len(self.fnodes), dtype=bool)
+        order = []
+        for root in range(len(self.vnodes)):
+            if var_seen[root]:
+                continue
+            var_seen[root] = True
+            start = len(order)
+            order.append((True, root, None))
+            for is_var, i, parent_edge in iter_from(order, start):
+                if is_var:
+                    edges = range(self.var_edge_ptr[i],
+                                  self.var_edge_ptr[i + 1])
+                else:
+                    edges = self.factor_edges[i]
+                for e in edges:
+                    if e == parent_edge:
+                        continue
+                    if is_var:
+                        j, seen = self.edge_factor[e], factor_seen
+                    else:
+                        j, seen = self.edge_var[e], var_seen
+                    if seen[j]:
+                        return None
+                    seen[j] = True
+                    order.append((not is_var, j, e))
+        return order
+
+    def run_tree(self, order):
+        """Compute exact messages on a tree (or forest) with one pass from the
+        leaves to the roots and one pass from the roots to the leaves.
+
+        Arguments
+        ---------
+        order : list
+            The node order returned by ``get_tree_order``.
+        """
+        for is_var, i, parent_edge in reversed(order):
+            if parent_edge is None:
+                continue
+            if is_var:
+                self.send_variable(i, only=parent_edge)
             else:
-                self.table[k] = np.log(v)
+                self.compute_factor(i, self.f2v, only=parent_edge)
+        for is_var, i, parent_edge in order:
+            if is_var:
+                self.send_variable(i, skip=parent_edge)
+            else:
+                self.compute_factor(i, self.f2v, skip=parent_edge)
 
-    def init_received(self):
-        self.received = {}
+    def iterate(self, pool=None, partition=None, damping=0.0):
+        """Run one flooding iteration, i.e., send the messages of all variables
+        and then those of all factors.
+
+        Arguments
+        ---------
+        pool: multiprocessing.pool.ThreadPool
+            If given, send the messages of the ranges of ``partition`` (see
+            ``get_partition``) concurrently. The variables are done before any
+            factor is started, so the result is the same as without a pool.
+
+        partition: tuple
+            The ranges of variables and factors, as returned by
+            ``get_partition``.
+
+        damping: float
+            Keep this fraction of the old factor-to-variable messages in the
+            log domain, i.e., the new messages are
+            ``damping * old + (1 - damping) * new``.
+
+        Returns
+        -------
+        The residual of the iteration, i.e., the maximum absolute change of
+        any message in the logarithmic domain.
+        """
+        v2f = self.v2f.copy()
+        f2v = self.f2v.copy()
+        if pool is None:
+            self.send_variables()
+            self.send_factors()
+        else:
+            var_ranges, factor_ranges = partition
+            pool.map(lambda r: self.send_variables(*r), var_ranges)
+            pool.map(lambda r: self.send_group(*r), factor_ranges)
+        if damping:
+            self.f2v *= 1 - damping
+            self.f2v += damping * f2v
+        self.f2v_change = self.f2v - f2v
+        if len(v2f) == 0:
+            return 0.0
+        return max(np.max(np.abs(self.v2f - v2f)),
+                   np.max(np.abs(self.f2v_change)))
+
+    def marginals(self):
+        """Compute the marginal distributions of all variables, which gives
+        an array indexed by slot positions."""
+        return np.exp(normalize_segments(
+            self.sum_messages(), self.var_offsets[:-1], self.slot_var))
+
+
+class BatchedBP:
+    """Flooding belief propagation on a ``CompiledGraph`` for a batch of
+    evidence sets at once.
+
+    The messages of every case are stored in a row of the two (batch size) x
+    (buffer size) arrays ``v2f`` and ``f2v``, laid out as the message
+    buffers of the compiled graph.
+    """
+    def __init__(self, compiled, evidence):
+        """
+        Arguments
+        ---------
+        compiled : CompiledGraph
+
+        evidence : numpy.ndarray
+            A (batch size) x (number of slots) array with the evidence of
+            every case, laid out as ``compiled.evidence``.
+        """
+        self.compiled = compiled
+        self.evidence = evidence
+        shape = (len(evidence), compiled.offsets[-1])
+        self.v2f = np.zeros(shape)
+        self.f2v = np.zeros(shape)
+
+    def sum_messages(self):
+        """Same as ``CompiledGraph.sum_messages``, for every case."""
+        compiled = self.compiled
+        total = self.evidence.copy()
+        if len(compiled.slot_starts):
+            total[:, compiled.used_slots] += np.add.reduceat(
+                self.f2v[:, compiled.slot_order], compiled.slot_starts,
+                axis=1)
+        return total
+
+    def send_variables(self):
+        """Same as ``CompiledGraph.send_variables``, for every case."""
+        compiled = self.compiled
+        total = self.sum_messages()
+        self.v2f[...] = normalize_segments(
+            total[:, compiled.elem_slot] - self.f2v, compiled.offsets[:-1],
+            compiled.elem_edge)
 
-    def send_one(self, target):
-        """Send a message to the target variable.
+    def send_factors(self):
+        """Same as ``CompiledGraph.send_factors``, for every case. The batch
+        is the first and the factor group the second axis of all
+        arrays."""
+        for group in self.compiled.groups:
+            ndim = group.tables.ndim + 1
+            msgs = [self.v2f[:, index] for index in group.index]
+            s = group.tables[np.newaxis]
+            for a, msg in enumerate(msgs):
+                s = s + expand_axis(msg, a + 2, ndim, batched=2)
+            for a, msg in enumerate(msgs):
+                others = tuple(j for j in range(2, ndim) if j != a + 2)
+                self.f2v[:, group.index[a]] = logsumexp(s, axis=others) - msg
 
+    def iterate(self):
+        """Same as ``CompiledGraph.iterate``, where the residual is the
+        maximum over all cases."""
+        v2f = self.v2f.copy()
+        f2v = self.f2v.copy()
+        self.send_variables()
+        self.send_factors()
+        if v2f.size == 0:
+            return 0.0
+        return max(np.max(np.abs(self.v2f - v2f)),
+                   np.max(np.abs(self.f2v - f2v)))
+
+    def marginals(self):
+        """Compute the marginal distributions of all variables for every
+        case, which gives a (batch size) x (number of slots) array."""
+        compiled = self.compiled
+        return np.exp(normalize_segments(
+            self.sum_messages(), compiled.var_offsets[:-1],
+            compiled.slot_var))
+
+
+class MarginalHistory:
+    """A preallocated buffer for the marginals of some variables of a
+    ``CompiledGraph`` over the iterations of a run."""
+    def __init__(self, compiled, variables, nrows):
+        """
+        Arguments
+        ---------
+        compiled : CompiledGraph
+
+        variables : list of int
+            Ids of the variables whose marginals are recorded.
+
+        nrows : int
+            The maximum number of times the marginals are recorded.
+        """
+        self.compiled = compiled
+        self.variables = variables
+        lo = compiled.var_offsets[variables]
+        hi = compiled.var_offsets[np.asarray(variables, dtype=int) + 1]
+        sizes = hi - lo
+        self.slots = np.array([i for a, b in zip(lo, hi) for i in range(a, b)],
+                              dtype=int)
+        self.offsets = np.zeros(len(variables) + 1, dtype=int)
+        self.offsets[1:] = np.cumsum(sizes)
+        self.segment_ids = np.repeat(np.arange(len(variables)), sizes)
+        self.buffer = np.empty((nrows, len(self.slots)))
+        self.nrows = 0
+
+    def record(self):
+        """Record the current marginals of the variables."""
+        total = self.compiled.sum_messages()[self.slots]
+        self.buffer[self.nrows] = np.exp(normalize_segments(
+            total, self.offsets[:-1], self.segment_ids))
+        self.nrows += 1
+
+    def get(self):
+        """Get a dictionary from variable names to arrays with one row of
+        marginals for every time they were recorded."""
+        return {self.compiled.vnodes[v].name:
+                self.buffer[:self.nrows, self.offsets[k]:self.offsets[k + 1]]
+                for k, v in enumerate(self.variables)}
+
+
+class AdaptiveDamping:
+    """Adaptive damping of the flooding schedule of a ``CompiledGraph``.
+
+    The messages of loopy factor graphs often oscillate, i.e., the change of
+    the factor-to-variable messages in one iteration points in the opposite
+    direction of the change in the previous one. Whenever this happens, the
+    step ``1 - damping`` is halved, up to ``max_damping``.
+    """
+    def __init__(self, damping, max_damping):
+        if not 0 <= damping <= max_damping < 1:
+            raise RuntimeError('Damping must satisfy '
+                               '0 <= damping <= max_damping < 1')
+        self.damping = damping
+        self.max_damping = max_damping
+        self.previous = None
+        self.oscillations = 0
+
+    def update(self, change):
+        """Raise the damping if ``change``, the change of the messages in the
+        last iteration, points against the change in the iteration before.
+
+        Returns
+        -------
+        The damping for the next iteration.
+        """
+        if self.previous is not None and np.dot(change, self.previous) < 0:
+            self.oscillations += 1
+            self.damping = min(self.max_damping, (1 + self.damping) / 2)
+        self.previous = change
+        return self.damping
+
+
+class ResidualSchedule:
+    """Residual belief propagation on a ``CompiledGraph``.
+
+    Instead of sending all messages in every iteration, the candidate new
+    message of every factor-to-variable edge is kept together with its
+    residual, i.e., the maximum absolute change in the log domain it would
+    cause. The message with the largest residual is sent first, after which
+    only the messages that depend on it are recomputed.
+    """
+    def __init__(self, compiled, variables=None, factors=None):
+        """
         Arguments
         ---------
-        target: str
-            The target variable, which should be a neighbor in the factor
-            graph.
-        """
-        # NOTE: Variable nodes in self.neighbors are in same order as in the
-        # factor table tuples.
-        target_index = self.neighbors.index(target)
-        msg = -np.Inf * np.ones(len(target.domain))
-        for comb, fvalue in self.table.items():
-            s = 0
-            for i, vnode in enumerate(self.neighbors):
-                if vnode != target:
-                    s += self.received[vnode][comb[i]]
-            s += fvalue
-            msg[comb[target_index]] = np.logaddexp(msg[comb[target_index]], s)
-        target.receive(self, msg)
+        compiled : CompiledGraph
+
+        variables : list of int
+            If given, only send the messages of these variables, and only
+            compute the messages of their neighboring factors and of
+            ``factors``. All other messages are assumed to be converged,
+            which allows to continue from the messages of a previous run.
+
+        factors : list of int
+            See ``variables``.
+        """
+        self.compiled = compiled
+        self.pending = compiled.f2v.copy()
+        if variables is None:
+            compiled.send_variables()
+            factors = range(len(compiled.fnodes))
+        else:
+            factors = set(factors)
+            for v in variables:
+                compiled.send_variable(v)
+                factors.update(compiled.edge_factor[
+                    compiled.var_edge_ptr[v]:compiled.var_edge_ptr[v + 1]])
+        for f in factors:
+            compiled.compute_factor(f, self.pending)
+        nedges = len(compiled.edge_var)
+        self.residuals = np.zeros(nedges)
+        if nedges:
+            self.residuals[:] = np.maximum.reduceat(
+                np.abs(self.pending - compiled.f2v), compiled.offsets[:-1])
+        # Heap entries are (-residual, version, edge). Entries whose version
+        # is outdated are skipped when popped.
+        self.versions = np.zeros(nedges, dtype=int)
+        self.heap = [(-self.residuals[e], 0, e)
+                     for e in np.flatnonzero(self.residuals)]
+        heapq.heapify(self.heap)
+
+    def get_residual(self):
+        """Get the largest residual of all pending messages."""
+        return self.residuals.max() if len(self.residuals) else 0.0
+
+    def update(self, e):
+        """Recompute the residual of edge ``e`` from its pending message."""
+        compiled = self.compiled
+        lo, hi = compiled.offsets[e], compiled.offsets[e + 1]
+        self.residuals[e] = np.max(
+            np.abs(self.pending[lo:hi] - compiled.f2v[lo:hi]))
+        self.versions[e] += 1
+        heapq.heappush(self.heap, (-self.residuals[e], self.versions[e], e))
+
+    def run(self, max_updates, tol=0):
+        """Send up to ``max_updates`` messages in the order of their residuals,
+        and stop early once no residual is larger than ``tol``.
+
+        Returns
+        -------
+        The number of messages that were sent.
+        """
+        compiled = self.compiled
+        updates = 0
+        while self.heap and updates < max_updates:
+            neg_residual, version, e = heapq.heappop(self.heap)
+            if version != self.versions[e]:
+                continue
+            if -neg_residual <= tol:
+                heapq.heappush(self.heap, (neg_residual, version, e))
+                break
+            lo, hi = compiled.offsets[e], compiled.offsets[e + 1]
+            compiled.f2v[lo:hi] = self.pending[lo:hi]
+            self.update(e)
+            updates += 1
+            # The messages of the receiving variable change along all other
+            # edges, and so do the pending messages of the factors at the
+            # other ends of those edges.
+            v = compiled.edge_var[e]
+            compiled.send_variable(v, skip=e)
+            for e2 in range(compiled.var_edge_ptr[v],
+                            compiled.var_edge_ptr[v + 1]):
+                if e2 == e:
+                    continue
+                f = compiled.edge_factor[e2]
+                compiled.compute_factor(f, self.pending, skip=e2)
+                for e3 in compiled.factor_edges[f]:
+                    if e3 != e2:
+                        self.update(e3)
+        return updates
 
 
 class FactorGraph:
@@ -136,11 +867,22 @@ class FactorGraph:
         self.vs = {}
         self.fs = set()
         self.vobs = {}
+        # For every evidence layer, the state of each variable it changed
+        # before the layer was pushed, as a tuple (observed, value).
+        self.evidence_layers = []
+        self.structure_version = 0
+        self.blanket_index = None
+        self.compiled = None
+        self.bp_info = None
+        self.layouts = {}
+        self.bn = bn
+        self.cpt_factors = {}  # The factor of the CPT of each variable.
         if bn is not None:
             for v in bn.vs.values():
                 self.add_variable(v.name, v.domain)
             for v in bn.vs.values():
-                self.add_factor(list(v.parents) + [v.name], v.cpt)
+                self.cpt_factors[v.name] = self.add_factor(
+                    list(v.parents) + [v.name], v.cpt)
 
     def add_variable(self, name, domain):
         """Add a variable node with the given name to the factor graph.
@@ -162,6 +904,7 @@ class FactorGraph:
         if name in self.vs:
             raise RuntimeError("Variable '{0}' already defined".format(name))
         self.vs[name] = vnode
+        self.structure_changed()
         return vnode
 
     def add_factor(self, variables, table):
@@ -195,8 +938,79 @@ class FactorGraph:
             vnode = self.vs[v]
             vnode.connect_to(fnode)
             fnode.connect_to(vnode)
+        self.structure_changed()
         return fnode
 
+    def set_cpt(self, variable, table=None):
+        """Replace the table of the factor that was created from the CPT of
+        ``variable``, which keeps the messages of the last run for a
+        warm-started ``run_bp``. A given table is set as the CPT of
+        ``variable`` in the Bayes net as well, so both stay in sync.
+
+        Arguments
+        ---------
+        variable : str
+            Name of a variable of the Bayes net the factor graph was built
+            from.
+
+        table : dict or numpy.ndarray
+            The new CPT in any of the forms accepted by
+            ``core.BayesNet.add_cpt``, with the parents in the same order as
+            before. It is converted and checked by ``add_cpt``. Defaults to
+            None, which takes the current CPT of ``variable`` in the Bayes
+            net, e.g., after ``add_cpt``.
+        """
+        if variable not in self.cpt_factors:
+            raise RuntimeError("Variable '{0}' has no CPT factor".format(
+                variable))
+        fnode = self.cpt_factors[variable]
+        parents = tuple(fnode.variables[:-1])
+        if table is not None:
+            self.bn.add_cpt(parents, variable, table)
+        v = self.bn.vs[variable]
+        if tuple(v.parents) != parents:
+            raise RuntimeError(
+                "The parents of '{0}' changed".format(variable))
+        fnode.set_table(self, v.cpt)
+
+    def structure_changed(self):
+        """Invalidate everything that was computed from the structure."""
+        self.blanket_index = None
+        self.compiled = None
+        self.layouts = {}
+        self.structure_version += 1
+
+    def tables_changed(self, fnode=None):
+        """Invalidate everything that was computed from the factor tables, or
+        just update the table of ``fnode`` if given."""
+        if self.compiled is not None and fnode in self.compiled.factor_ids:
+            self.compiled.update_table(self.compiled.factor_ids[fnode])
+        else:
+            self.compiled = None
+
+    def evidence_changed(self, name):
+        """Remember that the evidence on variable ``name`` changed, so that
+        a warm-started ``run_bp`` propagates the change."""
+        if self.compiled is not None:
+            self.compiled.evidence_changed(self.compiled.var_ids[name])
+
+    def get_compiled(self):
+        """Get the ``CompiledGraph`` of the current graph."""
+        if self.compiled is None:
+            self.compiled = CompiledGraph(self)
+        return self.compiled
+
+    def get_blanket_index(self):
+        """Get the ``MarkovBlanketIndex`` of the current graph structure."""
+        if self.blanket_index is None:
+            self.blanket_index = MarkovBlanketIndex(self)
+        return self.blanket_index
+
+    def get_markov_blanket(self, var):
+        """Get the names of all variables that share a factor with ``var``."""
+        index = self.get_blanket_index()
+        return set(index.names[i] for i in index.blankets[index.ids[var]])
+
     def to_networkx(self):
         """Convert the factor graph to an undirected networkx graph."""
         g = nx.Graph()
@@ -208,10 +1022,59 @@ class FactorGraph:
                 g.add_edge(v, u)
         return g
 
-    def draw(self):
-        """Draw the factor graph."""
+    def get_layout(self, layout='auto'):
+        """Get the positions of the nodes for drawing the factor graph.
+
+        Positions are computed once and reused until the structure changes.
+
+        Arguments
+        ---------
+        layout : str
+            Either 'spring', 'bipartite' for a layout with the variables in
+            one row and each factor below the mean position of its variables,
+            which is cheap to compute for large graphs, or 'auto' to use the
+            former for graphs with at most ``SPRING_LAYOUT_MAX_NODES`` nodes.
+
+        Returns
+        -------
+        A dictionary from variable and factor nodes to positions.
+        """
+        if layout == 'auto':
+            if len(self.vs) + len(self.fs) <= SPRING_LAYOUT_MAX_NODES:
+                layout = 'spring'
+            else:
+                layout = 'bipartite'
+        if layout not in self.layouts:
+            if layout == 'spring':
+                self.layouts[layout] = nx.spring_layout(self.to_networkx())
+            elif layout == 'bipartite':
+                pos = {}
+                vnodes = sorted(self.vs.values(), key=lambda v: v.name)
+                for k, vnode in enumerate(vnodes):
+                    pos[vnode] = np.array(
+                        [(2.0 * k + 1) / len(vnodes) - 1, 1.0])
+                for fnode in self.fs:
+                    pos[fnode] = np.array(
+                        [np.mean([pos[v][0] for v in fnode.neighbors]), -1.0])
+                self.layouts[layout] = pos
+            else:
+                raise RuntimeError("Unknown layout '{0}'".format(layout))
+        return self.layouts[layout]
+
+    def draw(self, layout='auto', filename=None):
+        """Draw the factor graph.
+
+        Arguments
+        ---------
+        layout : str
+            The layout of the nodes, see ``get_layout``.
+
+        filename : str
+            If given, save the figure to this file and close it instead of
+            leaving it open for ``plt.show``.
+        """
         g = self.to_networkx()
-        pos = nx.spring_layout(g)
+        pos = self.get_layout(layout)
         nx.draw_networkx_edges(g, pos,
                                edge_color=EDGE_COLOR,
                                width=EDGE_WIDTH)
@@ -227,40 +1090,275 @@ class FactorGraph:
         nx.draw_networkx_labels(g, pos, {v: v.name
                                          for v in self.vs.values()},
                                 font_color=LABEL_COLOR)
+        if filename is not None:
+            plt.savefig(filename)
+            plt.close()
 
-    def run_bp(self, niter):
+    def run_bp(self, niter, tol=None, schedule='auto', every=1,
+               variables=None, workers=None, damping=0.0, max_damping=None,
+               warm=False):
         """Run belief propagation for a number of iterations.
 
-        The algorithm alternates between sending messages from each variable
-        node its neighboring factor nodes and from each factor node to its
-        neighboring variable nodes. One iteration is completed when every
-        variable and factor node has send all its messages.
+        With the 'flooding' schedule, the algorithm alternates between sending
+        messages from each variable node its neighboring factor nodes and from
+        each factor node to its neighboring variable nodes. One iteration is
+        completed when every variable and factor node has send all its
+        messages.
+
+        With the 'residual' schedule, the factor-to-variable message whose
+        new value differs most from its current value is sent first, and only
+        the messages that depend on it are recomputed (see
+        ``ResidualSchedule``). Here, one iteration is completed after as many
+        messages have been sent as there are edges in the graph.
+
+        If the factor graph is a tree (or a forest), the 'tree' schedule sends
+        every message exactly once, first from the leaves to a root and then
+        back, which gives the exact marginals in a single iteration.
+
+        After the run, ``self.bp_info`` holds a dictionary with the number of
+        ``iterations`` that were run, the number of factor-to-variable message
+        ``updates``, the ``residual`` of the last iteration (the maximum
+        absolute change of any message in the log domain), whether the run
+        ``converged``, and the ``damping`` at the end of the run.
 
         Arguments
         ---------
         niter: int
-            The number of iterations.
+            The number of iterations, or the maximum number of iterations if
+            ``tol`` is given.
+
+        tol: float
+            If given, stop as soon as the residual is at most ``tol``.
+
+        schedule: str
+            Either 'flooding', 'residual', 'tree', or 'auto' to use the tree
+            schedule on trees and the flooding schedule otherwise.
+
+        every: int
+            Record the marginals before the first and after every
+            ``every``-th iteration, as well as after the last iteration. If
+            None, only record the marginals after the last iteration.
+
+        variables: iterable of str
+            The variables whose marginals are recorded. Defaults to None (all
+            variables).
+
+        workers: int
+            If given, send the messages of the flooding schedule with a pool
+            of ``workers`` threads, each of which takes a range of variables
+            and then a range of factors of every iteration. The results are
+            the same as with a single thread. The other schedules send their
+            messages one by one and ignore this argument.
+
+        damping: float
+            With the flooding schedule, keep this fraction of the old
+            factor-to-variable messages in the log domain at every iteration
+            (see ``CompiledGraph.iterate``), which helps loopy graphs to
+            converge. Must satisfy 0 <= damping < 1. Defaults to 0 (no
+            damping). The tree and residual schedules ignore damping, also
+            when the 'auto' schedule picks the tree schedule.
+
+        max_damping: float
+            If given, detect oscillating messages and raise the damping up to
+            ``max_damping`` when they do (see ``AdaptiveDamping``).
+
+        warm: bool
+            If True, start from the messages of the previous run instead of
+            uniform messages. Unless another schedule is given, only the
+            messages of the factors whose table changed and of the variables
+            whose evidence changed since then are recomputed, and the changes
+            are propagated outward with the residual schedule. This requires
+            that the messages of the previous run converged. If there are no
+            previous messages, e.g., because the graph structure changed,
+            all messages start from uniform as usual.
 
         Returns
         -------
-        A tuple containing (1) the marginal distribution of each variable at
-        each iteration, (2) the domain of each variable, and (3) the dictionary
-        of observed variables and their values.
+        A tuple containing (1) the marginal distribution of each recorded
+        variable at each recorded iteration, (2) the domain of each variable,
+        and (3) the dictionary of observed variables and their values.
         """
-        for v in self.vs.values():
-            v.init_received()
-        for f in self.fs:
-            f.init_received()
-        marg = {v: self.get_marginal(v) for v in self.vs}
-        for it in range(niter):
-            for v in self.vs.values():
-                v.send()
-            for f in self.fs:
-                f.send()
-            for v in self.vs:
-                marg[v] = np.vstack((marg[v], self.get_marginal(v)))
+        if schedule not in ('auto', 'flooding', 'residual', 'tree'):
+            raise RuntimeError("Unknown schedule '{0}'".format(schedule))
+        if not 0 <= damping < 1:
+            raise RuntimeError('Damping must satisfy 0 <= damping < 1')
+        if every is not None and every < 1:
+            raise RuntimeError('Every must be None or at least 1')
+        if variables is not None:
+            variables = list(variables)
+            self.check_variables(variables)
+        compiled = self.get_compiled()
+        warm = warm and compiled.has_messages
+        if not warm:
+            compiled.reset()
+        elif schedule == 'auto':
+            schedule = 'residual'
+        tree_order = None
+        if schedule in ('auto', 'tree'):
+            tree_order = compiled.get_tree_order()
+            if tree_order is None and schedule == 'tree':
+                raise RuntimeError('The factor graph is not a tree')
+            schedule = 'flooding' if tree_order is None else 'tree'
+        nedges = len(compiled.edge_var)
+        ids = {vnode.name: v for v, vnode in enumerate(compiled.vnodes)}
+        if variables is None:
+            variables = range(len(compiled.vnodes))
+        else:
+            variables = [ids[name] for name in variables]
+        nrows = 1 if every is None else niter // every + 2
+        history = MarginalHistory(compiled, list(variables), nrows)
+        if every is not None:
+            history.record()
+        recorded = 0
+        if schedule == 'residual' and warm:
+            residual_schedule = ResidualSchedule(compiled,
+                                                 *compiled.pop_dirty())
+        elif schedule == 'residual':
+            residual_schedule = ResidualSchedule(compiled)
+        if tol is None:
+            tol = 0
+            stop_early = False
+        else:
+            stop_early = True
+        adaptive = None
+        if max_damping is not None:
+            adaptive = AdaptiveDamping(damping, max_damping)
+        pool = partition = None
+        if schedule == 'flooding' and workers is not None and workers > 1:
+            pool = ThreadPool(workers)
+            partition = compiled.get_partition(workers)
+        residual = np.inf
+        it = 0
+        updates = 0
+        try:
+            while it < niter:
+                if schedule == 'tree':
+                    compiled.run_tree(tree_order)
+                    residual = 0.0
+                    sent = nedges
+                    updates += sent
+                    niter = it + 1
+                elif schedule == 'flooding':
+                    residual = compiled.iterate(pool, partition, damping)
+                    if adaptive is not None:
+                        damping = adaptive.update(compiled.f2v_change)
+                    sent = nedges
+                    # Messages to observed variables are not sent.
+                    updates += len(compiled.free_edges)
+                else:
+                    sent = residual_schedule.run(nedges, tol)
+                    residual = residual_schedule.get_residual()
+                    updates += sent
+                it += 1
+                if every is not None and it % every == 0:
+                    history.record()
+                    recorded = it
+                # The residual schedule stops early if no residual is above
+                # tol.
+                if (stop_early and residual <= tol) or sent < nedges:
+                    break
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        compiled.has_messages = True
+        compiled.pop_dirty()
+        if recorded != it or history.nrows == 0:
+            history.record()
+        marg = history.get()
+        self.bp_info = {'iterations': it, 'updates': updates,
+                        'residual': residual, 'converged': residual <= tol,
+                        'damping': damping}
         domains = {v.name: v.orig_domain for v in self.vs.values()}
-        return (marg, domains, self.vobs)
+        return (marg, domains, dict(self.vobs))
+
+    def run_bp_batch(self, observed, values, niter, tol=None,
+                     variables=None):
+        """Run flooding belief propagation for many evidence sets at once.
+
+        Every case is conditioned on the current evidence of the factor graph
+        and its own values of the ``observed`` variables. The messages of all
+        cases are sent with the same array operations (see ``BatchedBP``).
+
+        After the run, ``self.bp_info`` holds the same dictionary as after
+        ``run_bp``, where the residual is the maximum over all cases.
+
+        Arguments
+        ---------
+        observed: list of str
+            The variables observed in the cases.
+
+        values: array-like
+            A (number of cases) x (number of observed variables) array with
+            the observed value of every variable in every case.
+
+        niter: int
+            The number of iterations, or the maximum number of iterations if
+            ``tol`` is given.
+
+        tol: float
+            If given, stop as soon as the residual is at most ``tol``.
+
+        variables: iterable of str
+            The variables whose marginals are returned. Defaults to None (all
+            variables).
+
+        Returns
+        -------
+        A dictionary with a (number of cases) x (domain size) array of the
+        marginal distributions in every case for each variable.
+        """
+        self.check_variables(observed)
+        if variables is not None:
+            variables = list(variables)
+            self.check_variables(variables)
+        values = np.asarray(values, dtype=object)
+        if values.ndim != 2 or values.shape[1] != len(observed):
+            raise RuntimeError(
+                "Expected values of shape (cases, {0}), got {1}".format(
+                    len(observed), values.shape))
+        compiled = self.get_compiled()
+        ids = {vnode.name: v for v, vnode in enumerate(compiled.vnodes)}
+        ncases = len(values)
+        evidence = np.tile(compiled.evidence, (ncases, 1))
+        for j, name in enumerate(observed):
+            vnode = self.vs[name]
+            lo = compiled.var_offsets[ids[name]]
+            hi = compiled.var_offsets[ids[name] + 1]
+            try:
+                index = [vnode.orig2new[value] for value in values[:, j]]
+            except KeyError as e:
+                raise RuntimeError(
+                    "Unknown value '{0}' of variable '{1}'".format(
+                        e.args[0], name))
+            evidence[:, lo:hi] = -1e6
+            evidence[np.arange(ncases), lo + np.array(index, dtype=int)] = 0
+        batch = BatchedBP(compiled, evidence)
+        residual = np.inf
+        it = 0
+        while it < niter:
+            residual = batch.iterate()
+            it += 1
+            if tol is not None and residual <= tol:
+                break
+        nedges = len(compiled.edge_var)
+        self.bp_info = {'iterations': it, 'updates': it * nedges * ncases,
+                        'residual': residual,
+                        'converged': residual <= (tol or 0),
+                        'damping': 0.0}
+        if variables is None:
+            variables = [vnode.name for vnode in compiled.vnodes]
+        marg = batch.marginals()
+        return {name: marg[:, compiled.var_offsets[ids[name]]:
+                           compiled.var_offsets[ids[name] + 1]]
+                for name in variables}
+
+    def check_variables(self, variables):
+        """Raise an error if any of ``variables`` is not in the graph."""
+        unknown_vars = set(variables) - set(self.vs.keys())
+        if unknown_vars != set():
+            raise RuntimeError("Unknown variable '{0}'".format(
+                unknown_vars.pop()))
 
     def condition(self, observations):
         """Condition on the given observations.
@@ -268,31 +1366,87 @@ class FactorGraph:
         More precisely, for every ``(variable, value)`` pair in the provided
         dictionary ``observations``, the condition that ``variable`` is equal
         to ``value`` is *added* to the existing observations in the factor
-        graph (if any).
+        graph (if any). If an evidence layer has been pushed, the
+        observations are retracted when it is popped.
 
         Arguments
         ---------
         observations: dict of variable -> value
             The observed values for one or more variables in the factor graph.
         """
-        unknown_vars = set(observations.keys()) - set(self.vs.keys())
-        if unknown_vars != set():
-            raise RuntimeError("Unknown variable '{0}'".format(
-                unknown_vars.pop()))
-        self.vobs.update(observations)
+        self.check_variables(observations.keys())
+        # The evidence clamps each observed variable to its value, instead of
+        # adding a factor, so that the graph does not change.
         for name, value in observations.items():
-            table = {(d,): 0 for d in self.vs[name].orig_domain}
-            table[(value,)] = 1
-            # Check if there is an existing factor that is only connected
-            # to the observed variable. If that is the case, replace its
-            # table by a new table corresponding to the observed value,
-            # otherwise create a new factor with that table.
-            found = False
-            for fnode in self.fs:
-                if len(fnode.variables) == 1 and fnode.variables[0] == name:
-                    fnode.table = table
-            if not found:
-                fnode = self.add_factor((name,), table)
+            self.vs[name].observe(value)
+            self.evidence_changed(name)
+            self.record_evidence(name)
+            self.vobs[name] = value
+
+    def record_evidence(self, name):
+        """Remember the state of variable ``name`` before it is changed by
+        the top evidence layer, unless already done."""
+        if self.evidence_layers:
+            layer = self.evidence_layers[-1]
+            if name not in layer:
+                layer[name] = (name in self.vobs, self.vobs.get(name))
+
+    def push_evidence(self, observations=None):
+        """Push a new evidence layer and condition on the given observations
+        (see ``condition``). All changes to the evidence until the matching
+        ``pop_evidence`` are retracted by it.
+
+        Arguments
+        ---------
+        observations: dict of variable -> value
+            The observed values for one or more variables in the factor graph.
+        """
+        self.evidence_layers.append({})
+        if observations:
+            self.condition(observations)
+
+    def pop_evidence(self):
+        """Retract the top evidence layer, which takes time proportional to
+        the number of variables whose evidence it changed."""
+        if not self.evidence_layers:
+            raise RuntimeError('No evidence layer to pop')
+        layer = self.evidence_layers.pop()
+        for name, (observed, value) in layer.items():
+            if observed:
+                self.vs[name].observe(value)
+                self.evidence_changed(name)
+                self.vobs[name] = value
+            else:
+                self.vs[name].unobserve()
+                self.evidence_changed(name)
+                self.vobs.pop(name, None)
+
+    @contextmanager
+    def conditioned(self, observations):
+        """Condition on the given observations within a ``with`` block, e.g.,
+
+            with fgraph.conditioned({'Phone': 1}):
+                fgraph.run_bp(10)
+
+        Arguments
+        ---------
+        observations: dict of variable -> value
+            The observed values for one or more variables in the factor graph.
+        """
+        self.push_evidence(observations)
+        try:
+            yield self
+        finally:
+            self.pop_evidence()
+
+    def clear_evidence(self):
+        """Remove all observations, which can be undone by popping the current
+        evidence layer, if any."""
+        for name in list(self.vobs):
+            self.record_evidence(name)
+            self.vs[name].unobserve()
+            self.evidence_changed(name)
+            del self.vobs[name]
 
     def get_marginal(self, var):
         """Get the marginal probability distribution of variable ``var``.
@@ -309,7 +1463,84 @@ class FactorGraph:
         return self.vs[var].marginal()
 
 
-def normalize(logdist):
+def iter_from(items, start):
+    """Iterate over ``items`` from position ``start``, including items that
+    are appended during the iteration."""
+    i = start
+    while i < len(items):
+        yield items[i]
+        i += 1
+
+
+def expand_axis(msg, axis, ndim, batched=False):
+    """Reshape the 1-D array ``msg`` so that it broadcasts along axis
+    ``axis`` of an array with ``ndim`` dimensions.
+
+    If ``batched`` is True, ``msg`` is a 2-D array whose first axis is kept
+    as the first axis of the result. More generally, ``batched`` can be the
+    number of leading axes of ``msg`` that are kept.
+    """
+    shape = [1] * ndim
+    shape[axis] = msg.shape[-1]
+    for i in range(int(batched)):
+        shape[i] = msg.shape[i]
+    return msg.reshape(shape)
+
+
+def logsumexp(a, axis=None):
+    """Compute log(sum(exp(a))) along ``axis`` in a numerically stable way,
+    by subtracting the maximum before exponentiating.
+
+    Arguments
+    ---------
+    a: numpy.ndarray
+        Values in the logarithmic domain.
+
+    axis: int or tuple of int
+        The axes to sum over. Defaults to None (all axes).
+
+    Returns
+    -------
+    An array with the summed-over axes removed.
+    """
+    amax = np.max(a, axis=axis, keepdims=True)
+    amax[~np.isfinite(amax)] = 0
+    with np.errstate(divide='ignore'):
+        s = np.log(np.sum(np.exp(a - amax), axis=axis, keepdims=True))
+    s += amax
+    if axis is None:
+        return s.reshape(())
+    return np.squeeze(s, axis=axis)
+
+
+def normalize_segments(x, starts, segment_ids):
+    """Normalize consecutive segments of ``x`` as in ``normalize``.
+
+    Arguments
+    ---------
+    x: numpy.ndarray
+        Concatenated unnormalized distributions in the logarithmic domain
+        along the last axis.
+
+    starts: numpy.ndarray
+        Start position of every segment.
+
+    segment_ids: numpy.ndarray
+        The segment of every position of ``x``.
+
+    Returns
+    -------
+    The normalized segments again in the logarithmic domain.
+    """
+    if x.shape[-1] == 0:
+        return x.copy()
+    amax = np.maximum.reduceat(x, starts, axis=-1)
+    Z = np.log(np.add.reduceat(np.exp(x - amax[..., segment_ids]), starts,
+                               axis=-1)) + amax
+    return x - Z[..., segment_ids]
+
+
+def normalize(logdist, axis=-1):
     """Compute the following in a numerically stable way:
 
             logdist - log\sum_i\exp(logdist_i).
@@ -317,14 +1548,20 @@ def normalize(logdist):
     Arguments
     ---------
     logdist: iterable of float
-        An unnormalized distribution in the logarithmic domain.
+        An unnormalized distribution in the logarithmic domain, or an array
+        of such distributions along axis ``axis``, e.g., a 2-D array with one
+        distribution per row.
+
+    axis: int
+        The axis along which to normalize.
 
     Returns
     -------
     The normalized version of logdist again in the logarithmic domain.
     """
-    Z = reduce(np.logaddexp, logdist, -np.Inf)
-    return logdist - Z
+    logdist = np.asarray(logdist, dtype=float)
+    Z = logsumexp(logdist, axis=axis)
+    return logdist - np.expand_dims(Z, axis)
 
 
 def draw_marginals(marg, markers=True):
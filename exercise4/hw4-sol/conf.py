@@ -14,3 +14,7 @@ FACTOR_NODE_SIZE = 300
 FACTOR_NODE_COLOR = '#fdae61'
 FACTOR_NODE_SHAPE = 's'
 AXIS_OBSERVED_BG_COLOR = '#d9c4ad'
+
+# Larger graphs are drawn with the cheaper layered layouts by default.
+SPECTRAL_LAYOUT_MAX_NODES = 100
+SPRING_LAYOUT_MAX_NODES = 200
@@ -1,23 +1,59 @@
-from collections import defaultdict
+from collections import OrderedDict
+import matplotlib.pyplot as plt
 import networkx as nx
+import numpy as np
 from conf import *
 
 
 EPS = 1e-10
+# Networks with at least this many nodes use the array-based reachability
+# search by default.
+CSR_MIN_NODES = 5000
 
 
-def is_valid_cpt(table):
-    """Check that ``table`` contains valid conditional prob. distributions.
+def expand_csr(indptr, indices, ids):
+    """Get the concatenated neighbor lists of the nodes in ``ids`` from an
+    adjacency structure in compressed sparse row (CSR) format."""
+    starts = indptr[ids]
+    counts = indptr[ids + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return indices[offsets + np.arange(len(offsets))]
 
-    Note that the conditional distributions are defined over the last variable
-    in the tuples, while all other variables are conditioned on.
+
+def get_invalid_rows(cpt):
+    """Find the parent configurations for which ``cpt`` does not contain a
+    valid conditional probability distribution.
+
+    Note that the conditional distributions are defined over the last axis of
+    the array, while all other axes are conditioned on. A distribution is
+    invalid if any of its entries is missing (NaN) or outside [0, 1], or if
+    its entries do not sum up to one.
+
+    Arguments
+    ---------
+    cpt : numpy.ndarray
+        The CPT as a dense array.
+
+    Returns
+    -------
+    A list of index tuples into the parent axes of ``cpt``, one for each
+    invalid distribution.
     """
-    probabilities = defaultdict(float)
-    for combination, value in table.items():
-        if value < 0 or value > 1:
-            return False
-        probabilities[combination[:-1]] += value
-    return all(abs(total - 1) <= EPS for total in probabilities.values())
+    cpt = np.asarray(cpt, dtype=float)
+    out_of_bounds = np.isnan(cpt) | (cpt < 0) | (cpt > 1)
+    invalid = out_of_bounds.any(axis=-1)
+    invalid |= ~(np.abs(cpt.sum(axis=-1) - 1) <= EPS)
+    return [tuple(int(i) for i in row) for row in np.argwhere(invalid)]
+
+
+def is_valid_cpt(cpt):
+    """Check that ``cpt`` contains valid conditional prob. distributions.
+
+    Note that the conditional distributions are defined over the last axis of
+    the array, while all other axes are conditioned on. Missing entries are
+    marked as NaN and make the CPT invalid.
+    """
+    return not get_invalid_rows(cpt)
 
 
 class Variable:
@@ -25,17 +61,315 @@ class Variable:
     def __init__(self, name, domain, parents=None, cpt=None):
         self.name = name
         self.domain = domain
+        # Map the original domain values to their positions, which are used to
+        # index the axes of CPT arrays.
+        self.orig2new = dict(zip(domain, range(len(domain))))
         self.parents = parents
         self.cpt = cpt
 
 
-class BayesNet(nx.DiGraph):
-    """A Bayesian network as a directed graph."""
+class LRUCache:
+    """A dictionary of bounded size that drops the least recently used
+    entries first, and counts lookup hits and misses."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Get the value stored for ``key``, or None if there is none."""
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        """Store ``value`` for ``key``, possibly dropping an old entry."""
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all entries, but keep the hit and miss counts."""
+        self.entries.clear()
+
+    def info(self):
+        """Get a dictionary with the cache statistics."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'maxsize': self.maxsize, 'currsize': len(self.entries)}
+
+
+class StructureIndex:
+    """An integer-indexed snapshot of the structure of a directed acyclic
+    graph.
+
+    Nodes keep the integer ids of the graph. Parents and children are stored
+    both as lists and as arrays in compressed sparse row (CSR) format, e.g.,
+    the parents of node i are
+
+        parent_ids[parent_ptr[i]:parent_ptr[i + 1]].
+
+    Ancestor sets are stored as bitsets, i.e., ints whose i-th bit is set if
+    node i belongs to the set. They are only computed on first access, same
+    as the Markov blankets.
+    """
+    def __init__(self, graph):
+        self.nodes = list(graph.names)
+        self.ids = dict(graph.ids)
+        self.parents = [list(p) for p in graph.parent_lists]
+        self.children = [list(c) for c in graph.child_lists]
+        self.parent_ptr, self.parent_ids = self.to_csr(self.parents)
+        self.child_ptr, self.child_ids = self.to_csr(self.children)
+        # Topological order by repeatedly removing nodes without parents.
+        indegree = [len(p) for p in self.parents]
+        self.order = [i for i, d in enumerate(indegree) if d == 0]
+        for i in self.order:
+            for j in self.children[i]:
+                indegree[j] -= 1
+                if indegree[j] == 0:
+                    self.order.append(j)
+        if len(self.order) != len(self.nodes):
+            raise RuntimeError('The network contains a cycle')
+        self._ancestors = None
+        self._blankets = None
+
+    @staticmethod
+    def to_csr(lists):
+        """Convert a list of integer lists to CSR format."""
+        indptr = np.zeros(len(lists) + 1, dtype=int)
+        indptr[1:] = np.cumsum([len(l) for l in lists])
+        indices = np.fromiter((i for l in lists for i in l), dtype=int,
+                              count=indptr[-1])
+        return indptr, indices
+
+    @property
+    def ancestors(self):
+        """The ancestor bitset of each node."""
+        if self._ancestors is None:
+            # Every node is considered an ancestor of itself.
+            self._ancestors = [0] * len(self.nodes)
+            for i in self.order:
+                bits = 1 << i
+                for j in self.parents[i]:
+                    bits |= self._ancestors[j]
+                self._ancestors[i] = bits
+        return self._ancestors
+
+    @property
+    def blankets(self):
+        """The Markov blanket of each node, i.e., its parents, children, and
+        the other parents of its children, as sorted arrays of node ids."""
+        if self._blankets is None:
+            self._blankets = []
+            for i in range(len(self.nodes)):
+                blanket = set(self.parents[i])
+                for j in self.children[i]:
+                    blanket.add(j)
+                    blanket.update(self.parents[j])
+                blanket.discard(i)
+                self._blankets.append(np.array(sorted(blanket), dtype=int))
+        return self._blankets
+
+    def get_ancestor_mask(self, ids):
+        """Get the ancestors of the nodes ``ids`` as a boolean array, without
+        computing the ancestor bitsets."""
+        mask = np.zeros(len(self.nodes), dtype=bool)
+        frontier = np.unique(np.asarray(ids, dtype=int))
+        while len(frontier):
+            mask[frontier] = True
+            frontier = expand_csr(self.parent_ptr, self.parent_ids, frontier)
+            frontier = np.unique(frontier[~mask[frontier]])
+        return mask
+
+    def to_names(self, bits):
+        """Convert a bitset of node ids to a set of node names."""
+        return set(v for i, v in enumerate(self.nodes) if bits >> i & 1)
+
+    def mask_to_names(self, mask):
+        """Convert a boolean array over node ids to a set of node names."""
+        return set(self.nodes[i] for i in np.flatnonzero(mask))
+
+
+class BayesNet:
+    """A Bayesian network as a directed graph.
+
+    Nodes are stored by integer ids, which index a table of node names and
+    lists of parent and child ids. A ``networkx.DiGraph`` view is only built
+    when needed for drawing or by ``to_networkx``.
+
+    An index of the network structure is built the first time it is needed
+    and dropped whenever nodes or edges are added or removed.
+    """
 
     def __init__(self):
-        super(BayesNet, self).__init__()
+        self.names = []  # Node names indexed by id.
+        self.ids = {}  # Node ids indexed by name.
+        self.parent_lists = []  # Parent ids of each node.
+        self.child_lists = []  # Child ids of each node.
+        self.index = None
+        self.nx_graph = None
+        self.structure_version = 0
+        self.reachable_cache = None
+        self.layouts = {}
         self.vs = {}  # Variables of the network indexed by name.
 
+    def structure_changed(self):
+        """Invalidate everything that was computed from the structure."""
+        self.index = None
+        self.nx_graph = None
+        self.structure_version += 1
+        self.layouts = {}
+        if self.reachable_cache is not None:
+            self.reachable_cache.clear()
+
+    def enable_reachable_cache(self, maxsize=1024):
+        """Memoize the results of ``get_reachable``.
+
+        Results are cached by source node and observed set, and the least
+        recently used results are dropped once more than ``maxsize`` are
+        stored. The cache is cleared whenever the structure changes.
+        """
+        self.reachable_cache = LRUCache(maxsize)
+
+    def disable_reachable_cache(self):
+        """Stop memoizing the results of ``get_reachable``."""
+        self.reachable_cache = None
+
+    def get_reachable_cache_info(self):
+        """Get the hits, misses, maximum and current size of the cache of
+        ``get_reachable`` as a dictionary, or None if it is disabled."""
+        if self.reachable_cache is None:
+            return None
+        return self.reachable_cache.info()
+
+    def get_index(self):
+        """Get the ``StructureIndex`` of the current network structure."""
+        if self.index is None:
+            self.index = StructureIndex(self)
+        return self.index
+
+    def get_topological_order(self):
+        """Get the nodes of the network in a topological order."""
+        index = self.get_index()
+        return [index.nodes[i] for i in index.order]
+
+    def to_networkx(self):
+        """Get the network structure as a ``networkx.DiGraph``.
+
+        The graph is reused until the structure changes and should not be
+        modified.
+        """
+        if self.nx_graph is None:
+            self.nx_graph = nx.DiGraph()
+            self.nx_graph.add_nodes_from(self.names)
+            self.nx_graph.add_edges_from(self.edges())
+        return self.nx_graph
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def nodes(self):
+        """Get a list of all nodes."""
+        return list(self.names)
+
+    def edges(self):
+        """Get a list of all edges as (parent, child) tuples."""
+        return [(self.names[i], self.names[j])
+                for i, children in enumerate(self.child_lists)
+                for j in children]
+
+    def number_of_nodes(self):
+        return len(self.names)
+
+    def number_of_edges(self):
+        return sum(len(children) for children in self.child_lists)
+
+    def has_node(self, name):
+        return name in self.ids
+
+    def has_edge(self, u, v):
+        return (u in self.ids and v in self.ids and
+                self.ids[v] in self.child_lists[self.ids[u]])
+
+    def predecessors(self, name):
+        """Get a list of the parents of node ``name``."""
+        return [self.names[i] for i in self.parent_lists[self.get_id(name)]]
+
+    def successors(self, name):
+        """Get a list of the children of node ``name``."""
+        return [self.names[i] for i in self.child_lists[self.get_id(name)]]
+
+    def get_id(self, name):
+        """Get the integer id of node ``name``."""
+        try:
+            return self.ids[name]
+        except KeyError:
+            raise RuntimeError("Unknown node '{0}'".format(name))
+
+    def add_node(self, name):
+        """Add a node with the given name, unless it already exists."""
+        if name not in self.ids:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.parent_lists.append([])
+            self.child_lists.append([])
+            self.structure_changed()
+
+    def add_nodes_from(self, names):
+        for name in names:
+            self.add_node(name)
+
+    def add_edge(self, u, v):
+        """Add an edge from node ``u`` to node ``v``, adding the nodes if they
+        do not exist yet."""
+        self.add_node(u)
+        self.add_node(v)
+        i, j = self.ids[u], self.ids[v]
+        if j not in self.child_lists[i]:
+            self.child_lists[i].append(j)
+            self.parent_lists[j].append(i)
+            self.structure_changed()
+
+    def add_edges_from(self, edges):
+        for u, v in edges:
+            self.add_edge(u, v)
+
+    def remove_edge(self, u, v):
+        """Remove the edge from node ``u`` to node ``v``."""
+        if not self.has_edge(u, v):
+            raise RuntimeError("Unknown edge ('{0}', '{1}')".format(u, v))
+        i, j = self.ids[u], self.ids[v]
+        self.child_lists[i].remove(j)
+        self.parent_lists[j].remove(i)
+        self.structure_changed()
+
+    def remove_node(self, name):
+        """Remove node ``name`` and its edges. The ids of all nodes added
+        after it are decreased by one."""
+        k = self.get_id(name)
+
+        def renumber(ids):
+            return [i - (i > k) for i in ids if i != k]
+
+        del self.names[k]
+        del self.parent_lists[k]
+        del self.child_lists[k]
+        self.ids = {v: i for i, v in enumerate(self.names)}
+        self.parent_lists = [renumber(p) for p in self.parent_lists]
+        self.child_lists = [renumber(c) for c in self.child_lists]
+        self.structure_changed()
+
     def add_variable(self, name, domain):
         """Add a variable node with the given name to the network.
 
@@ -53,7 +387,7 @@ class BayesNet(nx.DiGraph):
         v = Variable(name, domain, None, None)
         self.vs[name] = v
 
-    def add_cpt(self, parents, variable, table):
+    def add_cpt(self, parents, variable, table, check=True):
         """Add a conditional probability table (CPT) to the network.
 
         Arguments
@@ -64,7 +398,7 @@ class BayesNet(nx.DiGraph):
         variable : str
             Variable for which the CPT is given.
 
-        table : dict
+        table : dict or numpy.ndarray
             The CPT as a dictionary from tuples of variable values to
             conditional probabilities in the following form:
 
@@ -72,6 +406,19 @@ class BayesNet(nx.DiGraph):
 
             In the above, p is the conditional probability of v having value
             v_v, given that its parents have values vp_1, vp_2, etc.
+
+            Alternatively, the CPT as a dense array with one axis per parent
+            (in the order given by ``parents``) followed by one axis for
+            ``variable``. Each axis is indexed by the position of a value in
+            the domain of the respective variable.
+
+        check : bool
+            If True, raise an error if the CPT is invalid. When adding many
+            CPTs, this can be turned off and all CPTs can be checked at once
+            with ``get_invalid_cpts``.
+
+        The CPT is always stored as a dense array of the latter form in the
+        ``cpt`` attribute of the variable.
         """
         if parents is None:
             parents = ()
@@ -82,23 +429,97 @@ class BayesNet(nx.DiGraph):
         for v in list(parents) + [variable]:
             if v not in self.vs:
                 raise RuntimeError("Unknown variable '{0}'".format(v))
-        # For CPTs with no parents, accept non-iterables as table keys for user
-        # convenience, but convert them to single-element tuples here.
-        newtable = {}
-        for c, v in table.items():
-            try:
-                newtable[tuple(c)] = v
-            except TypeError:
-                newtable[(c,)] = v
-        table = defaultdict(lambda: 0.5, newtable)
-        if not is_valid_cpt(table):
-            raise RuntimeError('Invalid CPT')
+        variables = parents + (variable,)
+        if isinstance(table, dict):
+            table = self.table_to_array(variables, table)
+        else:
+            table = np.array(table, dtype=float)
+            shape = tuple(len(self.vs[v].domain) for v in variables)
+            if table.shape != shape:
+                raise RuntimeError(
+                    "Expected CPT of shape {0}, got {1}".format(
+                        shape, table.shape))
+        if check:
+            rows = get_invalid_rows(table)
+            if rows:
+                raise RuntimeError(
+                    "Invalid CPT for '{0}' at parent values {1}".format(
+                        variable, self.index_to_values(parents, rows)))
         self.vs[variable].parents = parents
         self.vs[variable].cpt = table
         for parent in parents:
             if not self.has_edge(parent, variable):
                 self.add_edge(parent, variable)
 
+    def get_invalid_cpts(self, variables=None):
+        """Check the CPTs of the network for invalid distributions.
+
+        Arguments
+        ---------
+        variables : iterable of str
+            The variables whose CPTs should be checked. Defaults to None (all
+            variables that have a CPT).
+
+        Returns
+        -------
+        A dictionary from each variable with an invalid CPT to a list of the
+        parent value tuples (in the original domains) for which the
+        conditional distribution is invalid.
+        """
+        if variables is None:
+            variables = self.vs.keys()
+        invalid = {}
+        for name in variables:
+            v = self.vs[name]
+            if v.cpt is None:
+                continue
+            rows = get_invalid_rows(v.cpt)
+            if rows:
+                invalid[name] = self.index_to_values(v.parents, rows)
+        return invalid
+
+    def index_to_values(self, variables, indices):
+        """Map index tuples into the domains of ``variables`` to the tuples
+        of the respective original domain values."""
+        domains = [self.vs[v].domain for v in variables]
+        return [tuple(d[i] for d, i in zip(domains, index))
+                for index in indices]
+
+    def table_to_array(self, variables, table):
+        """Convert a table given as a dictionary to a dense array.
+
+        Arguments
+        ---------
+        variables : tuple of str
+            Variables corresponding to the elements of the table keys.
+
+        table : dict
+            Dictionary from tuples of variable values to table values.
+
+        Returns
+        -------
+        An array with one axis per variable. Entries that are missing from
+        ``table`` are set to NaN.
+        """
+        vs = [self.vs[v] for v in variables]
+        array = np.empty(tuple(len(v.domain) for v in vs))
+        array.fill(np.nan)
+        for c, p in table.items():
+            # For CPTs with no parents, accept non-iterables as table keys for
+            # user convenience.
+            try:
+                c = tuple(c)
+            except TypeError:
+                c = (c,)
+            if len(c) != len(vs):
+                raise RuntimeError("Invalid table key {0}".format(c))
+            try:
+                index = tuple(v.orig2new[value] for v, value in zip(vs, c))
+            except KeyError:
+                raise RuntimeError("Invalid table key {0}".format(c))
+            array[index] = p
+        return array
+
     def get_ancestors(self, variables):
         """Get all ancestors of the given variables.
 
@@ -110,16 +531,29 @@ class BayesNet(nx.DiGraph):
         -------
         A set with the ancestors.
         """
-        to_visit = set(variables)
-        ancestors = set()
-        while to_visit:
-            variable = to_visit.pop()
-            if variable not in ancestors:
-                ancestors.add(variable)
-                to_visit |= set(self.predecessors(variable))
-        return ancestors
-
-    def get_reachable(self, x, observed=None, plot=False):
+        index = self.get_index()
+        if len(index.nodes) >= CSR_MIN_NODES:
+            # Avoid building ancestor bitsets, which take quadratic memory.
+            return index.mask_to_names(index.get_ancestor_mask(
+                [index.ids[v] for v in variables]))
+        return index.to_names(self.get_ancestor_bits(variables))
+
+    def get_markov_blanket(self, variable):
+        """Get the Markov blanket of ``variable``, i.e., the set of its
+        parents, children, and other parents of its children."""
+        index = self.get_index()
+        return set(index.nodes[i] for i in index.blankets[index.ids[variable]])
+
+    def get_ancestor_bits(self, variables):
+        """Same as ``get_ancestors``, but return the ancestors as a bitset over
+        the node ids of ``get_index``."""
+        index = self.get_index()
+        bits = 0
+        for v in variables:
+            bits |= index.ancestors[index.ids[v]]
+        return bits
+
+    def get_reachable(self, x, observed=None, plot=False, method='auto'):
         """Get all nodes that are reachable from x, given the observed nodes.
 
         Arguments
@@ -134,6 +568,12 @@ class BayesNet(nx.DiGraph):
             If True, plot network with distinguishing colors for observable,
             reachable, and d-separated nodes.
 
+        method : str
+            Either 'bayesball' for a search over (variable, direction) pairs,
+            'csr' for a search with array frontiers on the CSR adjacency of
+            the network, which scales to very large networks, or 'auto' to use
+            the latter for networks with at least ``CSR_MIN_NODES`` nodes.
+
         Returns
         -------
         The set of reachable nodes.
@@ -141,8 +581,44 @@ class BayesNet(nx.DiGraph):
         if observed is None:
             observed = []
         observed = set(observed)
-        assert x in self.nodes()
-        assert observed <= set(self.nodes())
+        assert self.has_node(x)
+        assert all(self.has_node(v) for v in observed)
+        key = (x, frozenset(observed))
+        cached = None
+        if self.reachable_cache is not None:
+            cached = self.reachable_cache.get(key)
+        if cached is not None:
+            reachable = set(cached)
+        elif self.get_search_method(method) == 'csr':
+            index = self.get_index()
+            observed_mask = np.zeros(len(index.nodes), dtype=bool)
+            observed_mask[[index.ids[v] for v in observed]] = True
+            reachable = index.mask_to_names(self._search_reachable_csr(
+                index, index.ids[x], observed_mask,
+                index.get_ancestor_mask(np.flatnonzero(observed_mask))))
+        else:
+            reachable = self._search_reachable_bayesball(x, observed)
+        # Just a convention to not return the query node.
+        reachable.discard(x)
+        if cached is None and self.reachable_cache is not None:
+            self.reachable_cache.put(key, frozenset(reachable))
+        # Optionally plot.
+        if plot:
+            self.draw(x, observed, reachable)
+        return reachable
+
+    def get_search_method(self, method):
+        """Resolve the ``method`` argument of the reachability searches."""
+        if method == 'auto':
+            if self.number_of_nodes() >= CSR_MIN_NODES:
+                return 'csr'
+            return 'bayesball'
+        if method not in ('bayesball', 'csr'):
+            raise RuntimeError("Unknown search method '{0}'".format(method))
+        return method
+
+    def _search_reachable_bayesball(self, x, observed):
+        """Search for the nodes reachable from ``x``, including ``x``."""
         # First, find all ancestors of observed set.
         ancestors = self.get_ancestors(observed)
         # Then, perform a search for reachable variables starting from x.
@@ -166,29 +642,321 @@ class BayesNet(nx.DiGraph):
             # <--- V
             if not trail_entering and variable not in observed:
                 # <--- V <---
-                for predecessor in self.predecessors_iter(variable):
+                for predecessor in self.predecessors(variable):
                     to_visit.add((predecessor, False))
                 # <--- V --->
-                for successor in self.successors_iter(variable):
+                for successor in self.successors(variable):
                     to_visit.add((successor, True))
             # ---> V
             elif trail_entering:
                 # ---> V --->
                 if variable not in observed:  # only successors blocked.
-                    for successor in self.successors_iter(variable):
+                    for successor in self.successors(variable):
                         to_visit.add((successor, True))
                 # ---> V <---
                 elif variable in ancestors:
-                    for predecessor in self.predecessors_iter(variable):
+                    for predecessor in self.predecessors(variable):
                         to_visit.add((predecessor, False))
-        # Just a convention to not return the query node.
-        reachable.discard(x)
-        # Optionally plot.
-        if plot:
-            self.draw(x, observed, reachable)
         return reachable
 
-    def draw(self, x=None, observed=None, dependent=None):
+    @staticmethod
+    def _search_reachable_csr(index, source, observed, ancestors):
+        """Search for the nodes reachable from ``source`` on the CSR adjacency
+        of ``index``.
+
+        This is the same search as in ``get_reachable``, but all nodes that
+        are reached via an outgoing edge ("up") and via an incoming edge
+        ("down") in one step are expanded together with array operations.
+
+        Arguments
+        ---------
+        index : StructureIndex
+
+        source : int
+            Id of the source node.
+
+        observed, ancestors : numpy.ndarray
+            Boolean arrays marking the observed nodes and the ancestors of the
+            observed nodes.
+
+        Returns
+        -------
+        A boolean array that indicates the reachable nodes, including the
+        source node.
+        """
+        n = len(index.nodes)
+        visited_up = np.zeros(n, dtype=bool)
+        visited_down = np.zeros(n, dtype=bool)
+        up = np.array([source], dtype=int)
+        down = np.zeros(0, dtype=int)
+        while len(up) or len(down):
+            visited_up[up] = True
+            visited_down[down] = True
+            # <--- V <--- and <--- V --->
+            up = up[~observed[up]]
+            next_up = [expand_csr(index.parent_ptr, index.parent_ids, up)]
+            next_down = [expand_csr(index.child_ptr, index.child_ids, up)]
+            # ---> V --->
+            next_down.append(expand_csr(index.child_ptr, index.child_ids,
+                                        down[~observed[down]]))
+            # ---> V <---
+            next_up.append(expand_csr(index.parent_ptr, index.parent_ids,
+                                      down[observed[down] & ancestors[down]]))
+            up = np.concatenate(next_up)
+            up = np.unique(up[~visited_up[up]])
+            down = np.concatenate(next_down)
+            down = np.unique(down[~visited_down[down]])
+        return (visited_up | visited_down) & ~observed
+
+    def get_reachable_many(self, xs, observed=None, matrix=False,
+                           method='auto'):
+        """Get the nodes that are reachable from each of the source nodes
+        ``xs``, given the same observed nodes.
+
+        This gives the same results as calling ``get_reachable`` for every
+        source, but the ancestors of the observed nodes are only computed
+        once, and the searches from all sources share their visited states.
+
+        Arguments
+        ---------
+        xs : iterable of str
+            Source nodes.
+
+        observed : iterable of str
+            A set of observed variables. Defaults to None (no observations)
+
+        matrix : bool
+            If True, return the result as a boolean matrix instead of a
+            dictionary.
+
+        method : str
+            The search method, see ``get_reachable``. With 'csr', the sources
+            are searched one after the other.
+
+        Returns
+        -------
+        If ``matrix`` is False, a dictionary from each source node to the set
+        of nodes reachable from it. Otherwise, a tuple containing (1) a
+        len(xs) x N boolean array, whose entry (i, j) is True if node j is
+        reachable from source i, and (2) the list of the N nodes in the order
+        of the array columns.
+        """
+        if observed is None:
+            observed = []
+        observed = set(observed)
+        xs = list(xs)
+        assert all(self.has_node(x) for x in xs)
+        assert all(self.has_node(v) for v in observed)
+        index = self.get_index()
+        nodes = index.nodes
+        sources = [index.ids[x] for x in xs]
+        if self.get_search_method(method) == 'csr':
+            observed_mask = np.zeros(len(nodes), dtype=bool)
+            observed_mask[[index.ids[v] for v in observed]] = True
+            ancestor_mask = index.get_ancestor_mask(
+                np.flatnonzero(observed_mask))
+            reachable = np.zeros((len(xs), len(nodes)), dtype=bool)
+            for row, source in enumerate(sources):
+                reachable[row] = self._search_reachable_csr(
+                    index, source, observed_mask, ancestor_mask)
+                # Just a convention to not return the query node.
+                reachable[row, source] = False
+            if matrix:
+                return reachable, nodes
+            return {x: index.mask_to_names(row)
+                    for x, row in zip(xs, reachable)}
+        ancestors = self.get_ancestor_bits(observed)
+        is_observed = [v in observed for v in nodes]
+        is_ancestor = [bool(ancestors >> i & 1) for i in range(len(nodes))]
+        bitsets = self._search_reachable(
+            sources, index.parents, index.children, is_observed, is_ancestor)
+        # Just a convention to not return the query node.
+        bitsets = [b & ~(1 << i) for b, i in zip(bitsets, sources)]
+        if matrix:
+            nbytes = (len(nodes) + 7) // 8
+            packed = np.array(
+                [bytearray(b.to_bytes(nbytes, 'little')) for b in bitsets],
+                dtype=np.uint8).reshape(len(xs), nbytes)
+            reachable = np.unpackbits(packed, axis=1, bitorder='little')
+            return reachable[:, :len(nodes)].astype(bool), nodes
+        return {x: set(v for i, v in enumerate(nodes) if b >> i & 1)
+                for x, b in zip(xs, bitsets)}
+
+    def get_dependence_matrix(self, observed=None, method='auto'):
+        """Get which pairs of nodes are not d-separated by the observed nodes.
+
+        All nodes are used as sources of a single ``get_reachable_many``
+        search, so the ancestors of the observed nodes are computed once and
+        the visited states are shared among all nodes.
+
+        Arguments
+        ---------
+        observed : iterable of str
+            A set of observed variables. Defaults to None (no observations)
+
+        method : str
+            The search method, see ``get_reachable``.
+
+        Returns
+        -------
+        A tuple containing (1) a symmetric N x N boolean array, whose entry
+        (i, j) is True if nodes i and j are dependent given the observed
+        nodes, and (2) the list of the N nodes in the order of the array rows
+        and columns. The diagonal and all rows and columns of observed nodes
+        are False.
+        """
+        nodes = self.get_index().nodes
+        return self.get_reachable_many(nodes, observed, matrix=True,
+                                       method=method)
+
+    @staticmethod
+    def _search_reachable(sources, parents, children, is_observed,
+                          is_ancestor):
+        """Search for the nodes reachable from ``sources`` on integer node ids.
+
+        This is the same search as in ``get_reachable``, where a node that was
+        reached via an incoming edge is visited in state 2 * i + 1, and a node
+        that was reached via an outgoing edge is visited in state 2 * i. The
+        states and their transitions form a directed graph, whose strongly
+        connected components are found with Tarjan's algorithm. Since the
+        components are completed in reverse topological order, the set of
+        nodes reachable from a component is the union of its own nodes and
+        the sets of the components it leads to. Hence, every state is
+        expanded at most once, no matter how many sources are given.
+
+        Returns
+        -------
+        A list with the reachable nodes of each source as a bitset (an int
+        whose i-th bit is set if node i is reachable).
+        """
+        n = len(parents)
+        order = [-1] * (2 * n)
+        low = [0] * (2 * n)
+        bits = [0] * (2 * n)
+        on_stack = bytearray(2 * n)
+        stack = []
+        counter = 0
+
+        def successors(state):
+            variable, trail_entering = divmod(state, 2)
+            if not is_observed[variable]:
+                # <--- V <---
+                if not trail_entering:
+                    for u in parents[variable]:
+                        yield 2 * u
+                # <--- V ---> and ---> V --->
+                for u in children[variable]:
+                    yield 2 * u + 1
+            # ---> V <---
+            elif trail_entering and is_ancestor[variable]:
+                for u in parents[variable]:
+                    yield 2 * u
+
+        for source in sources:
+            if order[2 * source] >= 0:
+                continue
+            order[2 * source] = low[2 * source] = counter
+            counter += 1
+            stack.append(2 * source)
+            on_stack[2 * source] = 1
+            work = [(2 * source, successors(2 * source))]
+            while work:
+                state, it = work[-1]
+                for succ in it:
+                    if order[succ] < 0:
+                        order[succ] = low[succ] = counter
+                        counter += 1
+                        stack.append(succ)
+                        on_stack[succ] = 1
+                        work.append((succ, successors(succ)))
+                        break
+                    elif on_stack[succ]:
+                        low[state] = min(low[state], order[succ])
+                    else:
+                        bits[state] |= bits[succ]
+                else:
+                    work.pop()
+                    if low[state] == order[state]:
+                        # Collect the component and the union of everything
+                        # reachable from it.
+                        members = []
+                        component = 0
+                        while True:
+                            member = stack.pop()
+                            on_stack[member] = 0
+                            members.append(member)
+                            component |= bits[member]
+                            if not is_observed[member // 2]:
+                                component |= 1 << (member // 2)
+                            if member == state:
+                                break
+                        for member in members:
+                            bits[member] = component
+                    if work:
+                        parent = work[-1][0]
+                        if on_stack[state]:
+                            low[parent] = min(low[parent], low[state])
+                        else:
+                            bits[parent] |= bits[state]
+        return [bits[2 * source] for source in sources]
+
+    def get_layout(self, layout='auto'):
+        """Get the positions of the nodes for drawing the network.
+
+        Positions are computed once and reused until the structure changes.
+
+        Arguments
+        ---------
+        layout : str
+            Either 'spectral', 'topological' for a layout with one row per
+            topological level, which is cheap to compute for large networks,
+            or 'auto' to use the former for networks with at most
+            ``SPECTRAL_LAYOUT_MAX_NODES`` nodes.
+
+        Returns
+        -------
+        A dictionary from nodes to positions.
+        """
+        if layout == 'auto':
+            if self.number_of_nodes() <= SPECTRAL_LAYOUT_MAX_NODES:
+                layout = 'spectral'
+            else:
+                layout = 'topological'
+        if layout not in self.layouts:
+            if layout == 'spectral':
+                self.layouts[layout] = nx.spectral_layout(
+                    self.to_networkx())
+            elif layout == 'topological':
+                self.layouts[layout] = self.get_topological_layout()
+            else:
+                raise RuntimeError("Unknown layout '{0}'".format(layout))
+        return self.layouts[layout]
+
+    def get_topological_layout(self):
+        """Place every node in the row given by the length of the longest
+        path from a root to it. Within a row, nodes are ordered by the mean
+        position of their parents to reduce edge crossings."""
+        index = self.get_index()
+        depth = [0] * len(index.nodes)
+        for i in index.order:
+            for j in index.parents[i]:
+                depth[i] = max(depth[i], depth[j] + 1)
+        rows = [[] for _ in range(max(depth) + 1 if depth else 0)]
+        for i in index.order:
+            rows[depth[i]].append(i)
+        pos = {}
+        x = [0.0] * len(index.nodes)
+        for level, row in enumerate(rows):
+            row.sort(key=lambda i: np.mean([x[j] for j in index.parents[i]])
+                     if index.parents[i] else 0.0)
+            for k, i in enumerate(row):
+                x[i] = (2.0 * k + 1) / len(row) - 1
+                pos[index.nodes[i]] = np.array(
+                    [x[i], 1 - 2.0 * level / max(len(rows) - 1, 1)])
+        return pos
+
+    def draw(self, x=None, observed=None, dependent=None, layout='auto',
+             filename=None):
         """Draw the Bayesian network.
 
         Arguments
@@ -201,39 +969,50 @@ class BayesNet(nx.DiGraph):
 
         dependent : iterable of str
             The variables which are dependent on ``x`` given ``observed``.
+
+        layout : str
+            The layout of the nodes, see ``get_layout``.
+
+        filename : str
+            If given, save the figure to this file and close it instead of
+            leaving it open for ``plt.show``.
         """
-        pos = nx.spectral_layout(self)
-        nx.draw_networkx_edges(self, pos,
+        g = self.to_networkx()
+        pos = self.get_layout(layout)
+        nx.draw_networkx_edges(g, pos,
                                edge_color=EDGE_COLOR,
                                width=EDGE_WIDTH)
         if x or observed or dependent:
-            rest = list(
-                set(self.nodes()) - set([x]) - set(observed) - set(dependent))
+            rest = list(set(self.nodes()) - set([x]) -
+                        set(observed or []) - set(dependent or []))
         else:
             rest = self.nodes()
         if rest:
-            obj = nx.draw_networkx_nodes(self, pos, nodelist=rest,
+            obj = nx.draw_networkx_nodes(g, pos, nodelist=rest,
                                          node_size=NODE_SIZE,
                                          node_color=NODE_COLOR_NORMAL)
             obj.set_linewidth(NODE_BORDER_WIDTH)
             obj.set_edgecolor(NODE_BORDER_COLOR)
         if x:
-            obj = nx.draw_networkx_nodes(self, pos, nodelist=[x],
+            obj = nx.draw_networkx_nodes(g, pos, nodelist=[x],
                                          node_size=3000,
                                          node_color=NODE_COLOR_SOURCE,
                                          node_shape=NODE_SHAPE_SOURCE)
             obj.set_linewidth(NODE_BORDER_WIDTH)
             obj.set_edgecolor(NODE_BORDER_COLOR)
         if observed:
-            obj = nx.draw_networkx_nodes(self, pos, nodelist=list(observed),
+            obj = nx.draw_networkx_nodes(g, pos, nodelist=list(observed),
                                          node_size=NODE_SIZE,
                                          node_color=NODE_COLOR_OBSERVED)
             obj.set_linewidth(NODE_BORDER_WIDTH)
             obj.set_edgecolor(NODE_BORDER_COLOR)
         if dependent:
-            obj = nx.draw_networkx_nodes(self, pos, nodelist=list(dependent),
+            obj = nx.draw_networkx_nodes(g, pos, nodelist=list(dependent),
                                          node_size=NODE_SIZE,
                                          node_color=NODE_COLOR_REACHABLE)
             obj.set_linewidth(NODE_BORDER_WIDTH)
             obj.set_edgecolor(NODE_BORDER_COLOR)
-        nx.draw_networkx_labels(self, pos, font_color=LABEL_COLOR)
+        nx.draw_networkx_labels(g, pos, font_color=LABEL_COLOR)
+        if filename is not None:
+            plt.savefig(filename)
+            plt.close()
@@ -0,0 +1,200 @@
+import numpy as np
+import core
+
+
+HEURISTICS = ('min-fill', 'min-weight')
+
+
+class VariableElimination:
+    """Exact inference in a ``core.BayesNet`` by variable elimination.
+
+    Factors are given as tuples (variables, table), where the table is a dense
+    array with one axis per variable, like the CPTs of the network.
+    Elimination orders are computed greedily with the min-fill or min-weight
+    heuristic and cached by network structure, query and observed variables.
+    """
+    def __init__(self, bn, heuristic='min-fill', maxsize=1024):
+        """
+        Arguments
+        ---------
+        bn : core.BayesNet
+
+        heuristic : str
+            Either 'min-fill', which eliminates the variable that adds the
+            fewest edges between its neighbors first, or 'min-weight', which
+            eliminates the variable whose neighbors have the smallest product
+            of domain sizes first. Ties are broken by the other heuristic.
+
+        maxsize : int
+            The maximum number of cached elimination orders.
+        """
+        if heuristic not in HEURISTICS:
+            raise RuntimeError("Unknown heuristic '{0}'".format(heuristic))
+        self.bn = bn
+        self.heuristic = heuristic
+        self.orders = core.LRUCache(maxsize)
+
+    def get_order_cache_info(self):
+        """Get the hits, misses, maximum and current size of the cache of
+        elimination orders as a dictionary."""
+        return self.orders.info()
+
+    def query(self, query, evidence=None):
+        """Compute P(query | evidence) exactly.
+
+        Arguments
+        ---------
+        query : str or list of str
+            The query variable, or a list of query variables.
+
+        evidence : dict of variable -> value
+            The observed values of some variables of the network.
+
+        Returns
+        -------
+        If ``query`` is a single variable, an array with the probability of
+        each value in its domain. Otherwise, an array of the joint
+        probabilities with one axis per query variable.
+        """
+        if isinstance(query, str):
+            query = [query]
+        if evidence is None:
+            evidence = {}
+        for name in list(query) + list(evidence):
+            if name not in self.bn.vs:
+                raise RuntimeError("Unknown variable '{0}'".format(name))
+        for name in query:
+            if name in evidence:
+                raise RuntimeError(
+                    "Variable '{0}' is both queried and observed".format(
+                        name))
+        factors = self.get_factors(query, evidence)
+        for v in self.get_order(query, evidence, factors):
+            factors = eliminate(factors, v)
+        result = multiply(factors, query)
+        total = result.sum()
+        if total == 0:
+            raise RuntimeError('The evidence has probability zero')
+        return result / total
+
+    def get_factors(self, query, evidence):
+        """Get the CPTs of the ancestors of the query and observed variables,
+        sliced at the observed values. The CPTs of all other variables sum to
+        one and can be dropped.
+
+        Returns
+        -------
+        A list of factors (variables, table).
+        """
+        names = list(query) + list(evidence)
+        # Variables without parents or children are not nodes of the network.
+        relevant = set(names)
+        relevant.update(self.bn.get_ancestors(
+            [v for v in names if v in self.bn]))
+        factors = []
+        for name in sorted(relevant):
+            var = self.bn.vs[name]
+            if var.cpt is None:
+                raise RuntimeError("Variable '{0}' has no CPT".format(name))
+            variables = tuple(var.parents) + (name,)
+            index = []
+            for u in variables:
+                if u not in evidence:
+                    index.append(slice(None))
+                elif evidence[u] in self.bn.vs[u].orig2new:
+                    index.append(self.bn.vs[u].orig2new[evidence[u]])
+                else:
+                    raise RuntimeError(
+                        "Unknown value '{0}' of variable '{1}'".format(
+                            evidence[u], u))
+            factors.append((tuple(u for u in variables if u not in evidence),
+                            var.cpt[tuple(index)]))
+        return factors
+
+    def get_order(self, query, evidence, factors):
+        """Get the elimination order of the variables of ``factors`` that are
+        not queried, from the cache if possible."""
+        key = (self.bn.structure_version, self.heuristic, frozenset(query),
+               frozenset(evidence))
+        order = self.orders.get(key)
+        if order is None:
+            hidden = set(v for variables, _ in factors
+                         for v in variables) - set(query)
+            order = self.find_order(factors, hidden)
+            self.orders.put(key, order)
+        return order
+
+    def find_order(self, factors, hidden):
+        """Greedily find an order in which to eliminate the variables
+        ``hidden`` from ``factors``.
+
+        The variables of every factor are connected in an undirected graph.
+        Eliminating a variable connects all its neighbors, after which only
+        the scores of variables at distance at most two change.
+        """
+        neighbors = {}
+        for variables, _ in factors:
+            for v in variables:
+                neighbors.setdefault(v, set()).update(variables)
+        for v, nbrs in neighbors.items():
+            nbrs.discard(v)
+        scores = {v: self.get_score(v, neighbors) for v in hidden}
+        order = []
+        while scores:
+            v = min(scores, key=lambda u: (scores[u], u))
+            del scores[v]
+            order.append(v)
+            nbrs = neighbors.pop(v)
+            affected = set(nbrs)
+            for u in nbrs:
+                neighbors[u].discard(v)
+                neighbors[u].update(nbrs)
+                neighbors[u].discard(u)
+                affected.update(neighbors[u])
+            for u in affected:
+                if u in scores:
+                    scores[u] = self.get_score(u, neighbors)
+        return order
+
+    def get_score(self, v, neighbors):
+        """Get the score of eliminating ``v`` next, lower is better."""
+        nbrs = neighbors[v]
+        fill = sum(len(nbrs - neighbors[u]) - 1 for u in nbrs) // 2
+        weight = 1
+        for u in nbrs:
+            weight *= len(self.bn.vs[u].domain)
+        if self.heuristic == 'min-fill':
+            return (fill, weight)
+        return (weight, fill)
+
+
+def eliminate(factors, v):
+    """Multiply the factors that contain variable ``v`` and sum ``v`` out.
+
+    Returns
+    -------
+    The new list of factors.
+    """
+    inside = [f for f in factors if v in f[0]]
+    outside = [f for f in factors if v not in f[0]]
+    variables = []
+    for vs, _ in inside:
+        variables.extend(u for u in vs if u != v and u not in variables)
+    return outside + [(tuple(variables), multiply(inside, variables))]
+
+
+def multiply(factors, variables):
+    """Multiply ``factors`` and sum out all variables that are not in
+    ``variables``.
+
+    Returns
+    -------
+    An array with one axis per variable in ``variables``.
+    """
+    labels = {}
+    args = []
+    for vs, table in factors:
+        args.append(table)
+        args.append([labels.setdefault(u, len(labels)) for u in vs])
+    args.append([labels[u] for u in variables])
+    return np.einsum(*args)
@@ -59,16 +59,17 @@ class GibbsSampler:
         A randomly sampled value of ``v`` from the posterior P(v | state\{v}).
         """
         v_domain = self.vs[v].domain
-        prob = np.zeros(len(v_domain))
-        for d in v_domain:
-            for fnode in self.vs[v].neighbors:
-                comb = []
-                for fnode_var in fnode.variables:
-                    if fnode_var == v:
-                        comb.append(d)
-                    else:
-                        comb.append(state[fnode_var])
-                prob[d] += fnode.table[tuple(comb)]
+        # Start from the evidence, which clamps observed variables.
+        prob = self.vs[v].evidence.copy()
+        blanket_index = self.fgraph.get_blanket_index()
+        names = blanket_index.names
+        i = blanket_index.ids[v]
+        for f in blanket_index.var_factors[i]:
+            # Slice the factor table at the current state of all other
+            # variables in the factor, which leaves the values for all d.
+            index = tuple(slice(None) if j == i else state[names[j]]
+                          for j in blanket_index.factor_vars[f])
+            prob += blanket_index.factors[f].table[index]
         prob = bprop.normalize(prob)
         return npr.choice(v_domain, p=np.exp(prob))
 
@@ -119,7 +120,7 @@ class GibbsSampler:
                     samples[v].append(state[v])
         marginals = self.get_marginals(samples)
         domains = {v.name: v.orig_domain for v in self.vs.values()}
-        return (marginals, domains, self.fgraph.vobs)
+        return (marginals, domains, dict(self.fgraph.vobs))
 
     def get_marginals(self, samples):
         """Compute approximate marginals.